@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import time
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when a request was never recorded."""
+
+
+def request_key(request):
+    """Hash identifying a request by everything that affects the reply: model, messages, and response format."""
+    identity = {"model": request["model"], "messages": request["messages"],
+                "response_format": request.get("response_format")}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Records request/response pairs to a gzipped json-lines log, or replays them from it.
+
+    In record mode, every completion (streamed or not) is appended to the log along with how long it took. In
+    replay mode, requests are answered from the log without touching the network. Replies recorded several times
+    for the same request are served in the order they were recorded. Requests can be scoped (by session, say), so
+    that identical prompts from different players replay their own replies; replay falls back to any recording of
+    the request if its scope has none. latency_scale controls the simulated latency: 0 replies instantly, 1
+    reproduces the recorded timings."""
+    def __init__(self, path, mode="replay", latency_scale=0.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._entries = {}  # (scope, key) -> recorded entries, with a scope of None covering every scope
+        self._served = {}  # (scope, key) -> number of times replayed
+        self._file = None
+
+        if mode == "record":
+            self._file = gzip.open(path, "at", encoding="utf-8")
+        else:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._entries.setdefault((entry["scope"], entry["key"]), []).append(entry)
+                    if entry["scope"] is not None:
+                        self._entries.setdefault((None, entry["key"]), []).append(entry)
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def record(self, request, response, started, scope=None):
+        """Records a response received for the request. Streamed responses are wrapped, and recorded once they
+        have been read to the end."""
+        key = request_key(request)
+        if request.get("stream"):
+            return self._record_stream(key, scope, response, started)
+
+        self._write({"key": key, "scope": scope, "text": response.choices[0].message.content,
+                     "usage": response.usage.model_dump() if response.usage else None,
+                     "first_token": None, "latency": time.perf_counter() - started})
+        return response
+
+    async def replay(self, request, scope=None):
+        """Returns the recorded reply to the request, as the API would have returned it."""
+        key = request_key(request)
+        index = (scope, key)
+        if index not in self._entries:
+            index = (None, key)
+            if index not in self._entries:
+                raise CassetteMiss(f"No recording for request {key[:12]}")
+        entries = self._entries[index]
+        served = self._served.get(index, 0)
+        self._served[index] = served + 1
+        entry = entries[served % len(entries)]
+
+        if request.get("stream"):
+            return self._replay_stream(request, entry)
+        await self._sleep(entry["latency"])
+        return ChatCompletion.model_validate({
+            "id": f"chatcmpl-replay-{key[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": entry["text"]}, "finish_reason": "stop"}],
+            "usage": entry["usage"]
+        })
+
+    async def _record_stream(self, key, scope, stream, started):
+        parts = []
+        first_token = None
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self._write({"key": key, "scope": scope, "text": "".join(parts), "usage": None, "first_token": first_token,
+                     "latency": time.perf_counter() - started})
+
+    async def _replay_stream(self, request, entry):
+        text = entry["text"]
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+        first_token = entry["first_token"] if entry["first_token"] is not None else entry["latency"]
+        # Spread the time after the first token evenly over the remaining pieces
+        step = (entry["latency"] - first_token) / max(len(pieces) - 1, 1)
+
+        await self._sleep(first_token)
+        for i, piece in enumerate(pieces):
+            if i:
+                await self._sleep(step)
+            yield ChatCompletionChunk.model_validate({
+                "id": "chatcmpl-replay",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            })
+
+    async def _sleep(self, seconds):
+        if self.latency_scale and seconds:
+            await asyncio.sleep(seconds * self.latency_scale)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()  # Keeps the log readable up to here if the process dies mid-run
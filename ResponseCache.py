@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+def cache_key(*parts):
+    """Compact key for anything json-serializable, so that long prompts are not kept around as keys."""
+    return hashlib.sha256(json.dumps(parts, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class LayerStats:
+    __slots__ = ("hits", "misses", "evictions", "expirations")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations, "hit_rate": self.hit_rate}
+
+
+class ResponseCache:
+    """Keeps the text of model replies that can be reused across sessions, such as validity verdicts. Entries are
+    grouped into named layers (for statistics), and evicted least recently used first once the cache holds more than
+    max_entries entries or max_bytes of text, or once they are older than ttl seconds."""
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0  # Bytes of key and reply text held
+        self._entries = OrderedDict()  # (layer, key) -> (expiry time, text), from least to most recently used
+        self._stats = {}  # Layer -> LayerStats
+        self._pending = {}  # (layer, key) -> task producing the text, shared by concurrent lookups
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, layer, key):
+        """Returns the cached text, or None if there is none."""
+        text = self._lookup(layer, key)
+        stats = self._layer(layer)
+        if text is None:
+            stats.misses += 1
+        else:
+            stats.hits += 1
+        return text
+
+    async def fetch(self, layer, key, produce):
+        """Returns the cached text, or else awaits produce() for it and caches the result. Lookups of a key that is
+        already being produced wait for that instead of producing it again, and count as hits."""
+        stats = self._layer(layer)
+        text = self._lookup(layer, key)
+        if text is not None:
+            stats.hits += 1
+            return text
+
+        task = self._pending.get((layer, key))
+        if task is None:
+            stats.misses += 1
+            task = self._pending[(layer, key)] = asyncio.ensure_future(produce())
+            task.add_done_callback(lambda task: self._settle(layer, key, task))
+        else:
+            stats.hits += 1
+        # One caller giving up must not cancel the request the others are waiting for
+        return await asyncio.shield(task)
+
+    def put(self, layer, key, text):
+        if (layer, key) in self._entries:
+            self._remove((layer, key))
+        self._entries[(layer, key)] = (time.monotonic() + self.ttl, text)
+        self.size += len(key) + len(text)
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._layer(oldest[0]).evictions += 1
+
+    def stats(self):
+        return {layer: stats.to_dict() for layer, stats in self._stats.items()}
+
+    def export_prometheus(self, prefix="cyoa"):
+        """Renders the cache statistics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help_text in (("hits", "counter", "Replies served from the response cache."),
+                                      ("misses", "counter", "Lookups the response cache could not serve."),
+                                      ("evictions", "counter", "Replies evicted to stay within the size limits."),
+                                      ("expirations", "counter", "Replies found to be older than the ttl.")):
+            lines.append(f"# HELP {prefix}_response_cache_{name}_total {help_text}")
+            lines.append(f"# TYPE {prefix}_response_cache_{name}_total {kind}")
+            for layer, stats in sorted(self._stats.items()):
+                lines.append(f'{prefix}_response_cache_{name}_total{{layer="{layer}"}} {getattr(stats, name)}')
+        lines.append(f"# HELP {prefix}_response_cache_entries Replies held in the response cache.")
+        lines.append(f"# TYPE {prefix}_response_cache_entries gauge")
+        lines.append(f"{prefix}_response_cache_entries {len(self._entries)}")
+        return "\n".join(lines) + "\n"
+
+    def _lookup(self, layer, key):
+        entry = self._entries.get((layer, key))
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove((layer, key))
+            self._layer(layer).expirations += 1
+            return None
+        self._entries.move_to_end((layer, key))
+        return entry[1]
+
+    def _settle(self, layer, key, task):
+        del self._pending[(layer, key)]
+        if not task.cancelled() and task.exception() is None:
+            self.put(layer, key, task.result())
+
+    def _remove(self, index):
+        _, text = self._entries.pop(index)
+        self.size -= len(index[1]) + len(text)
+
+    def _layer(self, layer):
+        stats = self._stats.get(layer)
+        if stats is None:
+            stats = self._stats[layer] = LayerStats()
+        return stats
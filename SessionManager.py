@@ -0,0 +1,285 @@
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import socket
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from openai import AsyncOpenAI
+from ActionValidator import ActionValidator
+from GameManager import GameManager
+from ResponseCache import ResponseCache
+from StoryCatalog import StoryCatalog
+from StoryView import StoryView
+from Transport import Transport, Scheduler
+from TurnScheduler import TurnScheduler
+
+
+class SessionBusy(RuntimeError):
+    """Raised when another process is playing a turn of the session and does not finish in time."""
+
+
+class Session:
+    """The game state belonging to a single player. Idle sessions are frozen into a compressed blob."""
+    __slots__ = ("session_id", "gm", "frozen", "story_index", "game_over", "lock", "last_used", "seq", "unsaved", "view")
+
+    def __init__(self, session_id, gm):
+        self.session_id = session_id
+        self.gm = gm
+        self.frozen = None
+        self.story_index = 0
+        self.game_over = False
+        self.lock = asyncio.Lock()  # Only one turn per session may run at a time
+        self.last_used = time.monotonic()
+        self.seq = 0  # Sequence number of the last write to the store this copy of the game includes
+        self.unsaved = 0  # Journal entries written since the last snapshot
+        self.view = StoryView()  # What the player's browser has been sent
+
+
+class SessionManager:
+    """Gives every player their own GameManager. All sessions share one transport (and so one OpenAI client and one
+    request scheduler) and one copy of the story data. With a SessionStore, every game is also written to disk as it
+    is played, so sessions evicted from memory, or lost to a restart, are restored when their player returns.
+
+    Several processes may share one store. Each turn is then played under a lease on the session, and a process whose
+    copy of the session is behind the store (because another process played it last) reloads it first. Store calls run
+    on the store's thread; turns wait for the ones they depend on, and journal entries and snapshots are written
+    without holding up the player."""
+    def __init__(self, api_key, max_sessions=1000, ttl=3600, idle_after=300, sweep_interval=30, models=None,
+                 max_in_flight=32, rate=None, store=None, worker_id=None, lease_ttl=300, lease_wait=30,
+                 max_active_turns=64, max_queued_turns=256, max_turn_wait=30, world_lag=0):
+        self._story_data = StoryCatalog("story_data.json")
+        self.story_list = self._story_data.titles
+        self.prevalidator = ActionValidator()  # Shared, so its statistics cover every session
+        self.response_cache = ResponseCache()  # Validity and consistency verdicts, reused across sessions
+
+        # One client, and one scheduler bounding the requests in flight, for every session
+        self._transport = Transport(AsyncOpenAI(api_key=api_key), models=models,
+                                    scheduler=Scheduler(max_in_flight=max_in_flight, rate=rate))
+        # Admits whole turns, so that a burst of players queues up rather than flooding the scheduler above
+        self.turns = TurnScheduler(max_active=max_active_turns, max_queued=max_queued_turns, max_wait=max_turn_wait)
+        self._sessions = OrderedDict()  # Ordered from least to most recently used
+        self.store = store
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl  # Seconds before the lease of a process that died mid-turn runs out
+        self.lease_wait = lease_wait  # Seconds to wait for another process to finish a turn of the same session
+        self.world_lag = world_lag  # Turns whose world state updates a prompt may go without (see GameManager)
+
+        self.max_sessions = max_sessions
+        self.ttl = ttl  # Seconds of inactivity before a session is discarded
+        self.idle_after = idle_after  # Seconds of inactivity before a session is frozen
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+
+    @property
+    def tracer(self):
+        """Latency and token statistics of every session's model calls."""
+        return self._transport.tracer
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id, restore=True):
+        """Returns the session with the given id, creating or thawing it as needed. With restore, a session missing
+        from memory is read back from the store, blocking until it has been; turn leaves that to its lease check."""
+        self._maybe_sweep()
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._restore(session_id) if restore else None
+            if session is None:
+                session = Session(session_id, None)
+                session.gm = self._new_game_manager(session)
+                if self.store is not None and not restore:
+                    session.seq = None  # Not yet compared with the store, which may hold the game
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions and self._evict_oldest(keep=session_id):
+                pass
+        else:
+            self._sessions.move_to_end(session_id)
+            if session.frozen is not None:
+                self._thaw(session)
+
+        session.last_used = time.monotonic()
+        return session
+
+    @contextlib.asynccontextmanager
+    async def turn(self, session_id):
+        """Claims a session for the length of a turn: no other turn of it may run, in this process or any other
+        sharing the store. Raises SessionBusy if the session cannot be claimed within lease_wait seconds."""
+        # A session missing from memory starts out empty, and is loaded below once its lease is held
+        session = self.get(session_id, restore=False)
+        async with session.lock:
+            if self.store is None:
+                yield session
+                return
+
+            deadline = time.monotonic() + self.lease_wait
+            while not await self._acquire_lease(session_id):
+                if time.monotonic() >= deadline:
+                    raise SessionBusy(f"Session {session_id} is busy in another worker")
+                await asyncio.sleep(0.1)
+            try:
+                # Queued behind this session's journal writes, so it sees them
+                if await self._store_call(self.store.last_seq, session_id) != session.seq:
+                    self._apply(session, await self._store_call(self.store.load, session_id))
+                yield session
+            finally:
+                # Not awaited, so that a cancelled turn still releases it; later calls are queued behind it
+                self._store_submit(self._release_lease, session_id)
+
+    def drop(self, session_id):
+        """Discards a session, typically once the player has closed their tab."""
+        session = self._sessions.pop(session_id, None)
+        if session is not None and session.gm is not None:
+            session.gm.reset_game()
+        self.tracer.drop_session(session_id)
+        if self.store is not None:
+            self._store_submit(self.store.delete, session_id)
+
+    def save(self, session):
+        """Writes a snapshot of the session's whole game, such as when a new game has been started."""
+        if self.store is not None:
+            # The state is taken now; the write is queued behind the journal entries it already covers
+            session.unsaved = 0
+            self._store_submit(self._save_snapshot, session, session.gm.export_state(), session.story_index)
+
+    def record(self, session, entry):
+        """Journals a turn, world update, or conclusion of the session's game (GameManager passes each to its
+        journal_hook), compacting the journal into a snapshot now and then."""
+        if self.store is None:
+            return
+        self._store_submit(self._append, session, entry)
+        session.unsaved += 1
+        if session.unsaved >= self.store.snapshot_every:
+            self.save(session)
+
+    def sweep(self):
+        """Discards expired sessions and freezes idle ones."""
+        now = time.monotonic()
+        self._last_sweep = now
+        if self.store is not None:
+            self._store_submit(self.store.expire, self.ttl)
+
+        for session_id in list(self._sessions):
+            session = self._sessions[session_id]
+            idle = now - session.last_used
+            if idle < self.idle_after:
+                break  # Everything after this point was used more recently
+            if session.lock.locked() or (session.gm is not None and session.gm.busy):
+                continue
+            if idle >= self.ttl:
+                del self._sessions[session_id]
+                self.tracer.drop_session(session_id)
+            elif session.frozen is None:
+                self._freeze(session)
+
+        # Sessions kept past max_sessions because they were busy when others arrived
+        while len(self._sessions) > self.max_sessions and self._evict_oldest():
+            pass
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+    def _evict_oldest(self, keep=None):
+        """Evicts the least recently used session (other than keep, the one being handed out) that is neither mid-turn
+        nor working in the background. Returns
+        False if there is none, in which case the pool stays over max_sessions until the next sweep or new session
+        finds one."""
+        for session_id, session in self._sessions.items():
+            if session_id != keep and not session.lock.locked() and (session.gm is None or not session.gm.busy):
+                del self._sessions[session_id]
+                self.tracer.drop_session(session_id)
+                return True
+        # Evicting a session mid-turn would let a second turn of it start under a new lock
+        print(f"Every session is busy; keeping {len(self._sessions)} sessions for now")
+        return False
+
+    def _restore(self, session_id):
+        """Rebuilds a session from the store, if it has one."""
+        if self.store is None:
+            return None
+        session = Session(session_id, None)
+        return session if self._reload(session) else None
+
+    def _reload(self, session):
+        """Replaces the session's game with the copy in the store. Returns False if the store has none."""
+        return self._apply(session, self.store.submit(self.store.load, session.session_id).result())
+
+    def _apply(self, session, stored):
+        """Replaces the session's game with one loaded from the store. Returns False if there was none."""
+        if stored is None:
+            return False
+        state, story_index, entries, seq = stored
+
+        gm = self._new_game_manager(session)
+        gm.load_state(state)
+        for entry in entries:
+            gm.replay(entry)
+        if session.gm is not None:
+            session.gm.reset_game()  # Stops its background work
+        session.gm = gm
+        session.frozen = None
+        session.story_index = story_index
+        session.game_over = gm.action_number == 0
+        session.seq = seq
+        session.unsaved = len(entries)
+        return True
+
+    async def _store_call(self, method, *args):
+        """Runs a store call on the store's thread, leaving the event loop free meanwhile."""
+        return await asyncio.wrap_future(self.store.submit(method, *args))
+
+    def _store_submit(self, method, *args):
+        """Queues a store call on the store's thread without waiting for it."""
+        self.store.submit(method, *args).add_done_callback(self._report_store_error)
+
+    @staticmethod
+    def _report_store_error(future):
+        if future.exception() is not None:
+            print(f"Session store write failed: {future.exception()}")
+
+    async def _acquire_lease(self, session_id):
+        try:
+            return await self._store_call(self.store.acquire_lease, session_id, self.worker_id, self.lease_ttl)
+        except sqlite3.OperationalError as e:
+            # Another process has held the database past the busy timeout; try again like any other busy lease
+            print(f"Acquiring the lease on session {session_id} failed: {e}")
+            return False
+
+    # Run on the store's thread, so that the sequence number is current by the time any later call is made
+    def _append(self, session, entry):
+        session.seq, _ = self.store.append(session.session_id, entry)
+
+    def _save_snapshot(self, session, state, story_index):
+        session.seq = self.store.save_snapshot(session.session_id, state, story_index)
+
+    def _release_lease(self, session_id, attempts=3):
+        # A lease left behind keeps other processes out of the session until it expires, so retry a locked database
+        for attempt in range(attempts):
+            try:
+                return self.store.release_lease(session_id, self.worker_id)
+            except sqlite3.OperationalError:
+                if attempt == attempts - 1:
+                    raise
+
+    def _new_game_manager(self, session):
+        gm = GameManager(transport=self._transport, story_data=self._story_data, session_id=session.session_id,
+                         prevalidator=self.prevalidator, response_cache=self.response_cache, world_lag=self.world_lag)
+        gm.journal_hook = functools.partial(self.record, session)
+        return gm
+
+    def _freeze(self, session):
+        state = json.dumps(session.gm.export_state(), separators=(",", ":"))
+        session.frozen = zlib.compress(state.encode("utf-8"))
+        session.gm = None
+
+    def _thaw(self, session):
+        gm = self._new_game_manager(session)
+        gm.load_state(json.loads(zlib.decompress(session.frozen).decode("utf-8")))
+        session.gm = gm
+        session.frozen = None
@@ -0,0 +1,140 @@
+import concurrent.futures
+import json
+import sqlite3
+import time
+import zlib
+
+
+class SessionStore:
+    """Durable record of every session's game, kept in SQLite: a compact snapshot of the whole game state, plus an
+    append-only journal of what has happened since (turns with the world updates they made, and conclusions).
+    A session is restored by loading its snapshot and replaying the journal on top, so games survive restarts and
+    can be picked up by any process that opens the same database. Processes sharing the database take a lease on a
+    session for the length of each turn, so that only one of them plays it at a time.
+
+    Every call blocks on disk and on other processes' writes. Code running on an event loop should go through submit,
+    which runs calls one at a time on the store's own thread."""
+    def __init__(self, path="sessions.db", snapshot_every=10, busy_timeout=1.0):
+        self.path = path
+        self.snapshot_every = snapshot_every  # Journal entries written before the session is compacted into a snapshot
+        # Other processes only hold the database for a single short write. Anything longer raises
+        # sqlite3.OperationalError rather than holding up every write queued behind it.
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._db.execute("PRAGMA journal_mode=WAL")  # Appends do not block readers
+        self._db.execute("PRAGMA synchronous=NORMAL")  # A power cut may lose the last few turns, never corrupt the rest
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                session_id TEXT PRIMARY KEY,
+                story_index INTEGER NOT NULL,
+                state BLOB NOT NULL,
+                seq INTEGER NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS journal (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                entry TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                session_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+        """)
+
+    def submit(self, method, *args):
+        """Queues a call (of a store method, or a function calling them) on the store's thread, returning a
+        concurrent.futures.Future. Calls run in the order they were submitted."""
+        return self._executor.submit(method, *args)
+
+    def save_snapshot(self, session_id, state, story_index):
+        """Replaces the session's snapshot with the given state (from GameManager.export_state) and discards the
+        journal entries it covers."""
+        blob = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            seq = self._last_seq(session_id)
+            self._db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                             (session_id, story_index, blob, seq, time.time()))
+            self._db.execute("DELETE FROM journal WHERE session_id = ? AND seq <= ?", (session_id, seq))
+        return seq
+
+    def append(self, session_id, entry):
+        """Appends an entry to the session's journal. Returns the entry's sequence number, and how many entries the
+        journal now holds past the snapshot, so the caller can tell when to compact it."""
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            seq = self._last_seq(session_id) + 1
+            self._db.execute("INSERT INTO journal VALUES (?, ?, ?)",
+                             (session_id, seq, json.dumps(entry, separators=(",", ":"))))
+            row = self._db.execute("UPDATE snapshots SET updated = ? WHERE session_id = ? RETURNING seq",
+                                   (time.time(), session_id)).fetchone()
+        return seq, seq - (row[0] if row else 0)
+
+    def last_seq(self, session_id):
+        """Sequence number of the session's latest write. A process holding an older copy of the session should
+        load it again."""
+        return self._last_seq(session_id)
+
+    def load(self, session_id):
+        """Returns the session's snapshot state, story index, the journal entries written since, and the sequence
+        number of the last of them, or None if the session was never stored."""
+        # Read the journal in the same transaction as the snapshot, so a compaction in between cannot hide entries
+        with self._db:
+            self._db.execute("BEGIN")
+            row = self._db.execute("SELECT story_index, state, seq FROM snapshots WHERE session_id = ?",
+                                   (session_id,)).fetchone()
+            if row is None:
+                return None
+            story_index, blob, seq = row
+            entries = [json.loads(entry) for (entry,) in self._db.execute(
+                "SELECT entry FROM journal WHERE session_id = ? AND seq > ? ORDER BY seq", (session_id, seq))]
+            last_seq = self._last_seq(session_id)
+        return json.loads(zlib.decompress(blob).decode("utf-8")), story_index, entries, last_seq
+
+    def acquire_lease(self, session_id, owner, ttl=300):
+        """Claims the session for the owner until it is released, or for ttl seconds should the owner die holding it.
+        Returns False if another owner holds an unexpired lease."""
+        now = time.time()
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(session_id) DO UPDATE "
+                "SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.expires < ? OR leases.owner = excluded.owner",
+                (session_id, owner, now + ttl, now))
+        return cursor.rowcount == 1
+
+    def release_lease(self, session_id, owner):
+        with self._db:
+            self._db.execute("DELETE FROM leases WHERE session_id = ? AND owner = ?", (session_id, owner))
+
+    def delete(self, session_id):
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM snapshots WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM journal WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM leases WHERE session_id = ?", (session_id,))
+
+    def expire(self, ttl):
+        """Deletes every session that has not been written to in ttl seconds."""
+        cutoff = time.time() - ttl
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM journal WHERE session_id IN "
+                             "(SELECT session_id FROM snapshots WHERE updated < ?)", (cutoff,))
+            self._db.execute("DELETE FROM snapshots WHERE updated < ?", (cutoff,))
+            self._db.execute("DELETE FROM leases WHERE expires < ?", (time.time(),))
+
+    def close(self):
+        """Finishes the submitted calls, then closes the database."""
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    def _last_seq(self, session_id):
+        row = self._db.execute("SELECT MAX(seq) FROM journal WHERE session_id = ?", (session_id,)).fetchone()
+        if row[0] is not None:
+            return row[0]
+        row = self._db.execute("SELECT seq FROM snapshots WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
@@ -0,0 +1,110 @@
+import json
+import mmap
+import os
+from collections import OrderedDict
+from WorldState import WorldState
+
+
+class StoryCatalog:
+    """The authored stories, loaded one at a time as games need them.
+
+    The catalog file (a json list of stories, as in story_data.json) is indexed once: the title, byte offset, and
+    length of every story are written to an index file next to it, which is rebuilt whenever the catalog changes.
+    Listing titles only reads the index, and a story is parsed from its slice of the memory-mapped catalog the first
+    time it is played. Recently played stories are kept parsed, along with a template world state that new games
+    fork rather than copy."""
+    def __init__(self, path="story_data.json", index_path=None, cache_size=64):
+        self.path = path
+        self.index_path = index_path or path + ".index"
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # Index -> (story, template world), from least to most recently used
+        self._stories = None  # Set instead of the file fields for catalogs built from a list
+
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        self._entries = self._load_index(stat)
+        self.titles = [entry["title"] for entry in self._entries]
+
+    @classmethod
+    def from_stories(cls, stories):
+        """Wraps stories that are already in memory, such as a list loaded from json."""
+        catalog = cls.__new__(cls)
+        catalog.path = catalog.index_path = None
+        catalog.cache_size = len(stories)
+        catalog._cache = OrderedDict()
+        catalog._stories = stories
+        catalog._map = None
+        catalog._entries = None
+        catalog.titles = [story["title"] for story in stories]
+        return catalog
+
+    def __len__(self):
+        return len(self.titles)
+
+    def story(self, index):
+        """Returns the story as a dict in the story_data.json format. It is shared, so must not be changed."""
+        return self._get(index)[0]
+
+    def world(self, index):
+        """Returns a fresh world state for a new game of the story."""
+        return self._get(index)[1].fork()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def _get(self, index):
+        cached = self._cache.get(index)
+        if cached is not None:
+            self._cache.move_to_end(index)
+            return cached
+
+        if self._stories is not None:
+            story = self._stories[index]
+        else:
+            entry = self._entries[index]
+            story = json.loads(self._map[entry["offset"]:entry["offset"] + entry["length"]])
+        cached = self._cache[index] = (story, WorldState.from_story(story))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return cached
+
+    def _load_index(self, stat):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                return index["stories"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "stories": self._build_index()}
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(temp_path, self.index_path)  # Other processes see either the old index or the whole new one
+        except OSError as e:
+            print(f"Could not write story index: {e}")
+        return index["stories"]
+
+    def _build_index(self):
+        """Finds the title and byte range of every story in the catalog with a single pass of the decoder."""
+        text = bytes(self._map).decode("utf-8")
+        decoder = json.JSONDecoder()
+        entries = []
+        position = text.index("[") + 1
+        char_position, byte_position = 0, 0  # Running conversion from character to byte offsets
+
+        while True:
+            while text[position] in " \t\r\n,":
+                position += 1
+            if text[position] == "]":
+                return entries
+            story, end = decoder.raw_decode(text, position)
+            byte_position += len(text[char_position:position].encode("utf-8"))
+            length = len(text[position:end].encode("utf-8"))
+            entries.append({"title": story["title"], "offset": byte_position, "length": length})
+            char_position, byte_position = end, byte_position + length
+            position = end
@@ -0,0 +1,106 @@
+import asyncio
+
+
+def estimate_tokens(text):
+    """Rough token estimate for English prose (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+class StoryContext:
+    """Builds the story section of prompts from the introduction, a running summary of older turns,
+    and the most recent turns verbatim. The summary is brought up to date in the background."""
+    def __init__(self, prompt_fn, window=3, token_budget=3000):
+        self._prompt_fn = prompt_fn  # GameManager._prompt_ai
+        self.window = window  # Number of recent turns (action and outcome) kept verbatim
+        self.token_budget = token_budget  # Upper bound on the tokens spent on the story in a single prompt
+
+        self.summary = ""
+        self.summarized = 1  # Entries of the story before this index are covered by the summary
+        self._task = None
+
+    def reset(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.summary = ""
+        self.summarized = 1
+
+    @property
+    def busy(self):
+        """Whether a summarization is running in the background."""
+        return self._task is not None and not self._task.done()
+
+    def export_state(self):
+        return {"summary": self.summary, "summarized": self.summarized}
+
+    def load_state(self, state):
+        self.reset()
+        self.summary = state["summary"]
+        self.summarized = state["summarized"]
+
+    def render(self, story):
+        """Returns the story text to embed in a prompt, staying within the token budget."""
+        if not story:
+            return ""
+
+        introduction = story[0]
+        budget = self.token_budget - estimate_tokens(introduction)
+        header = ""
+        if self.summary:
+            header = f"Summary of earlier events:\n{self.summary}\n\nRecent events:"
+            budget -= estimate_tokens(header)
+
+        # Take the newest entries first until the budget is spent. Entries are only ever dropped here
+        # if the summary has not caught up with them yet.
+        recent = []
+        for entry in reversed(story[max(self.summarized, 1):]):
+            cost = estimate_tokens(entry)
+            if cost > budget and recent:
+                break
+            recent.append(entry)
+            budget -= cost
+        recent.reverse()
+
+        parts = [introduction]
+        if header:
+            parts.append(header)
+        parts.extend(recent)
+        return "\n".join(parts)
+
+    def schedule_update(self, story):
+        """Starts a background summarization if turns have fallen out of the verbatim window."""
+        if self._task is not None and not self._task.done():
+            return  # The running task picks up anything new once it finishes
+        if self._pending_end(story) > self.summarized:
+            self._task = asyncio.create_task(self._update(story))
+
+    async def wait(self):
+        """Waits for any in-flight summarization to finish."""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _pending_end(self, story):
+        # The introduction is always kept, and each turn is an action followed by its outcome
+        return max(len(story) - 2 * self.window, 1)
+
+    async def _update(self, story):
+        while (end := self._pending_end(story)) > self.summarized:
+            new_events = "\n".join(story[self.summarized:end])
+            try:
+                summary = (await self._prompt_fn([
+                    {
+                        "role": "system",
+                        "content": "Your job is to maintain a running summary of a story. You will be given the current summary, which may be empty, followed by the events that have happened since. Rewrite the summary so that it also covers the new events. Keep every detail that could matter later in the story, such as items gained or lost, characters met, places visited, and promises made, but leave out descriptive flourishes. Return only the summary."
+                    },
+                    {
+                        "role": "user",
+                        "content": f"Current summary:\n{self.summary}\n\nNew events:\n{new_events}"
+                    }
+                ], "summary")).choices[0].message.content
+            except Exception as e:
+                # The unsummarized turns are still sent verbatim, so a failure here only costs tokens
+                print(f"Error updating story summary: {e}")
+                return
+
+            self.summary = summary
+            self.summarized = end
@@ -0,0 +1,73 @@
+class StatusRenderer:
+    """Renders the world state as the Story Information section of prompts.
+
+    Each entity's text is cached until the entity is replaced, and each section is only rebuilt once its
+    collection changes. Sections run from static story data to volatile state, so that consecutive prompts
+    share as long a prefix as possible for provider-side prompt caching."""
+    def __init__(self, world, conclusion):
+        self.world = world
+        self._conclusion = f"Intended Conclusion: \n```{conclusion}```\n\n"
+        self._entity_text = {}  # Section name -> {key: (entity, text)}
+        self._sections = {}  # Section name -> (version, text)
+        self._player = (None, "")
+        self._status = (None, "")
+
+    def render(self, conclusion=True):
+        world = self.world
+        versions = (world.player, world.locations.version, world.items.version, world.characters.version,
+                    world.inventory.version)
+        if self._status[0] != versions:
+            self._status = (versions, "".join((
+                self._player_text(),
+                f"\n\nStory Setting: {world.setting}",
+                self._section("locations", world.locations, "", "Location", self._location),
+                self._section("items", world.items, "\n\nObjects outside player inventory:", "Object", self._item),
+                self._section("characters", world.characters, "\n\nCharacters:", "Character", self._character),
+                self._section("inventory", world.inventory, "\n\nPlayer Inventory:", None, self._inventory_item)
+            )))
+
+        # The conclusion never changes during a game, so it goes first and only costs a concatenation
+        return self._conclusion + self._status[1] if conclusion else self._status[1]
+
+    def _player_text(self):
+        player = self.world.player
+        if self._player[0] is not player:
+            self._player = (player, f"Player Character:\n\tName: {player.name}\n\tLocation: {player.location}\n\tDescription: {player.description}")
+        return self._player[1]
+
+    def _section(self, name, entities, heading, label, render_entity):
+        """Renders a collection, numbering its entries if it has a label. Empty collections are left out."""
+        cached = self._sections.get(name)
+        if cached is not None and cached[0] == entities.version:
+            return cached[1]
+
+        previous = self._entity_text.get(name, {})
+        current = {}
+        parts = [heading] if len(entities) > 0 else []
+        for i, (key, entity) in enumerate(entities.items(), 1):
+            entry = previous.get(key)
+            if entry is None or entry[0] is not entity:
+                entry = (entity, render_entity(entity))
+            current[key] = entry
+            parts.append(f"\n\n{label} {i}: {entry[1]}" if label else entry[1])
+        self._entity_text[name] = current  # Drops the text of removed entities
+
+        text = "".join(parts)
+        self._sections[name] = (entities.version, text)
+        return text
+
+    @staticmethod
+    def _location(location):
+        return f"{location.name}\n\tRelative area: {location.area}\n\tDescription: {location.description}"
+
+    @staticmethod
+    def _item(item):
+        return f"{item.name}\n\tLocation: {item.location}\n\tDescription: {item.description}"
+
+    @staticmethod
+    def _character(character):
+        return f"{character.name}\n\tlocation: {character.location}\n\tdescription: {character.description}"
+
+    @staticmethod
+    def _inventory_item(item):
+        return f"\n\tItem: {item.name}\n\tDescription: {item.description}"
@@ -0,0 +1,89 @@
+from StoryStatus import StatusRenderer
+
+# Collections of the world state shown in the status panel, with their headings and how to render an entry
+PANEL_SECTIONS = (
+    ("locations", "Locations", StatusRenderer._location),
+    ("items", "Objects outside player inventory", StatusRenderer._item),
+    ("characters", "Characters", StatusRenderer._character),
+    ("inventory", "Player Inventory", StatusRenderer._inventory_item)
+)
+
+
+class StoryView:
+    """Tracks what a player's browser has been sent of their game, so that each update to it carries only what has
+    changed: text added to the story, and entities added, replaced, or removed in the world state. The browser
+    applies the updates to its own copy (see the scripts in userint.py). Anything the view cannot express as a change,
+    such as a new game, is sent in full."""
+    def __init__(self):
+        # Numbers the updates of each panel, so that the browser can tell a repeated, missed, or reordered update
+        self._seq = {"story": 0, "status": 0}
+        self._gm = None
+        self._story = None  # Length of every story entry sent
+        self._world = None
+        self._player = None
+        self._panel = {}  # Section name -> (version, {key: entity}) as sent
+
+    def reset(self):
+        """Forgets what was sent, so that the next updates send everything."""
+        self._gm = None
+        self._story = None
+        self._world = None
+
+    def story_update(self, gm):
+        """Returns the changes to the story since the last update."""
+        story = gm.current_story
+        ops = []
+        full = self._story is None or self._gm is not gm
+        if full:
+            self._gm = gm
+            self._story = []
+        elif len(story) < len(self._story):
+            ops.append({"truncate": len(story)})  # A failed turn was taken back
+            del self._story[len(story):]
+
+        for i, entry in enumerate(story):
+            sent = self._story[i] if i < len(self._story) else None
+            if sent == len(entry):
+                continue
+            # Entries only ever grow while streaming; any other change resends the entry
+            offset = sent if sent is not None and sent < len(entry) else 0
+            ops.append({"index": i, "offset": offset, "text": entry[offset:]})
+            if sent is None:
+                self._story.append(len(entry))
+            else:
+                self._story[i] = len(entry)
+        return self._update("story", full, ops)
+
+    def status_update(self, gm):
+        """Returns the changes to the world state since the last update."""
+        world = gm.world
+        full = self._world is not world
+        sections = {}
+        if full:
+            self._world = world
+            self._player = None
+            self._panel = {}
+            sections["setting"] = {"heading": "Story Setting", "upsert": {"setting": world.setting}}
+
+        player = world.player
+        if self._player is not player:
+            self._player = player
+            text = f"Name: {player.name}\n\tLocation: {player.location}\n\tDescription: {player.description}"
+            sections["player"] = {"heading": "Player Character", "upsert": {"player": text}}
+
+        for name, heading, render_entity in PANEL_SECTIONS:
+            entities = getattr(world, name)
+            version, sent = self._panel.get(name, (None, {}))
+            if version == entities.version:
+                continue
+            current = dict(entities.items())
+            upsert = {key: render_entity(entity) for key, entity in current.items() if sent.get(key) is not entity}
+            remove = [key for key in sent if key not in current]
+            self._panel[name] = (entities.version, current)
+            if upsert or remove:
+                sections[name] = {"heading": heading, "upsert": upsert, "remove": remove}
+        return self._update("status", full, sections)
+
+    def _update(self, panel, full, changes):
+        self._seq[panel] += 1
+        return {"seq": self._seq[panel], "reset": full, "changes": changes}
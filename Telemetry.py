@@ -0,0 +1,243 @@
+import asyncio
+import bisect
+import contextlib
+import time
+from collections import deque
+
+# Ways a call can be abandoned by whoever was waiting on it, which say nothing about the call itself
+CANCELLATIONS = (asyncio.CancelledError, GeneratorExit)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+
+class Span:
+    """Timing and token usage of a single model call, or of a whole turn."""
+    __slots__ = ("call_type", "session", "started", "queue_wait", "first_token", "latency", "attempts",
+                 "prompt_tokens", "completion_tokens", "error", "cancelled", "verdict", "speculation")
+
+    def __init__(self, call_type, session):
+        self.call_type = call_type
+        self.session = session
+        self.started = time.perf_counter()
+        self.queue_wait = 0.0  # Time spent waiting for the scheduler, summed over attempts
+        self.first_token = None  # Seconds until the first streamed content, for streamed calls
+        self.latency = None
+        self.attempts = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.error = None
+        self.cancelled = False
+        self.verdict = None  # How a turn's action was judged: "valid", "inconsistent", or "invalid"
+        self.speculation = None  # A speculative turn's branch, latency saved and tokens wasted
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Estimates a quantile by interpolating within the bucket it falls in."""
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def to_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self.bounds + ("+Inf",), self._cumulative())}
+        return {"buckets": buckets, "sum": self.sum, "count": self.count,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+    def _cumulative(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class CallStats:
+    """Aggregated spans of one call type."""
+    __slots__ = ("count", "errors", "cancelled", "prompt_tokens", "completion_tokens", "json_ok", "json_failed",
+                 "latency", "queue_wait", "first_token", "speculative_kept", "speculative_discarded",
+                 "latency_saved", "tokens_wasted")
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.json_ok = 0
+        self.json_failed = 0
+        self.latency = Histogram(buckets)
+        self.queue_wait = Histogram(buckets)
+        self.first_token = Histogram(buckets)
+        self.speculative_kept = 0  # Speculative turns that kept a speculated branch
+        self.speculative_discarded = 0  # Speculative turns that threw every speculated branch away
+        self.latency_saved = 0.0
+        self.tokens_wasted = 0
+
+    def add(self, span):
+        self.prompt_tokens += span.prompt_tokens
+        self.completion_tokens += span.completion_tokens
+        if span.cancelled:
+            # Not a completed call, and its latency was cut short
+            self.cancelled += 1
+            return
+        self.count += 1
+        if span.error is not None:
+            self.errors += 1
+        self.latency.observe(span.latency)
+        self.queue_wait.observe(span.queue_wait)
+        if span.first_token is not None:
+            self.first_token.observe(span.first_token)
+        if span.speculation:
+            if span.speculation.get("branch") is not None:
+                self.speculative_kept += 1
+            else:
+                self.speculative_discarded += 1
+            self.latency_saved += span.speculation.get("latency_saved", 0.0)
+            self.tokens_wasted += span.speculation.get("tokens_wasted", 0)
+
+    def to_dict(self):
+        return {"count": self.count, "errors": self.errors, "cancelled": self.cancelled, "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens, "json_ok": self.json_ok, "json_failed": self.json_failed,
+                "latency": self.latency.to_dict(), "queue_wait": self.queue_wait.to_dict(),
+                "first_token": self.first_token.to_dict(),
+                "speculation": {"kept": self.speculative_kept, "discarded": self.speculative_discarded,
+                                "latency_saved": self.latency_saved, "tokens_wasted": self.tokens_wasted}}
+
+
+class Tracer:
+    """Collects spans for every model call (labelled by call type, such as validate or outcome) and every turn,
+    aggregated per process and per session. Recent spans are kept for working out a turn's critical path."""
+    def __init__(self, buckets=DEFAULT_BUCKETS, recent=2000):
+        self.buckets = buckets
+        self.calls = {}  # Call type -> CallStats, for the whole process
+        self.sessions = {}  # Session -> {call type -> CallStats}
+        self.recent = deque(maxlen=recent)
+
+    def start(self, call_type, session=None):
+        return Span(call_type, session)
+
+    @contextlib.contextmanager
+    def span(self, call_type, session=None):
+        """Context manager timing the code inside it as a span."""
+        span = self.start(call_type, session)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span, e)
+            raise
+        self.finish(span)
+
+    def finish(self, span, error=None):
+        span.latency = time.perf_counter() - span.started
+        if isinstance(error, CANCELLATIONS):
+            span.cancelled = True
+        elif error is not None:
+            span.error = type(error).__name__
+        self._stats(self.calls, span.call_type).add(span)
+        if span.session is not None:
+            self._stats(self.sessions.setdefault(span.session, {}), span.call_type).add(span)
+        self.recent.append(span)
+        return span
+
+    def json_decoded(self, call_type, session, ok):
+        """Records whether a call's reply could be decoded as the json it was asked for."""
+        targets = [self.calls] + ([self.sessions.setdefault(session, {})] if session is not None else [])
+        for calls in targets:
+            stats = self._stats(calls, call_type)
+            if ok:
+                stats.json_ok += 1
+            else:
+                stats.json_failed += 1
+
+    def drop_session(self, session):
+        self.sessions.pop(session, None)
+
+    def session_summary(self, session):
+        return {call_type: stats.to_dict() for call_type, stats in self.sessions.get(session, {}).items()}
+
+    def dump_histograms(self):
+        """Returns the process-wide statistics of every call type, histograms included, as a json-able dict."""
+        return {call_type: stats.to_dict() for call_type, stats in self.calls.items()}
+
+    def recent_spans(self, session=None):
+        return [span.to_dict() for span in self.recent if session is None or span.session == session]
+
+    def export_prometheus(self, prefix="cyoa"):
+        """Renders the process-wide statistics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{prefix}_{name}{suffix}{{{label_text}}} {value}")
+
+        calls = sorted(self.calls.items())
+        metric("llm_requests_total", "counter", "Model calls (or turns) completed.",
+               [("", {"call_type": call_type}, stats.count) for call_type, stats in calls])
+        metric("llm_errors_total", "counter", "Model calls (or turns) that failed.",
+               [("", {"call_type": call_type}, stats.errors) for call_type, stats in calls])
+        metric("llm_cancelled_total", "counter", "Model calls (or turns) abandoned before they completed.",
+               [("", {"call_type": call_type}, stats.cancelled) for call_type, stats in calls])
+        metric("llm_tokens_total", "counter", "Tokens sent and received.",
+               [("", {"call_type": call_type, "kind": kind}, tokens) for call_type, stats in calls
+                for kind, tokens in (("prompt", stats.prompt_tokens), ("completion", stats.completion_tokens))])
+        metric("llm_json_decode_total", "counter", "Replies decoded as json, by result.",
+               [("", {"call_type": call_type, "result": result}, count) for call_type, stats in calls
+                for result, count in (("ok", stats.json_ok), ("error", stats.json_failed)) if stats.json_ok or stats.json_failed])
+
+        speculated = [(call_type, stats) for call_type, stats in calls if stats.speculative_kept or stats.speculative_discarded]
+        metric("speculative_turns_total", "counter", "Speculative turns, by whether a speculated branch was kept.",
+               [("", {"call_type": call_type, "branch": branch}, count) for call_type, stats in speculated
+                for branch, count in (("kept", stats.speculative_kept), ("discarded", stats.speculative_discarded))])
+        metric("speculation_latency_saved_seconds_total", "counter", "Time saved by running branches alongside validation.",
+               [("", {"call_type": call_type}, stats.latency_saved) for call_type, stats in speculated])
+        metric("speculation_tokens_wasted_total", "counter", "Tokens spent on speculated branches that were thrown away.",
+               [("", {"call_type": call_type}, stats.tokens_wasted) for call_type, stats in speculated])
+
+        for name, attribute, help_text in (("llm_latency_seconds", "latency", "Total time of the call."),
+                                           ("llm_queue_wait_seconds", "queue_wait", "Time spent waiting for the scheduler."),
+                                           ("llm_first_token_seconds", "first_token", "Time until the first streamed content.")):
+            samples = []
+            for call_type, stats in calls:
+                histogram = getattr(stats, attribute)
+                if histogram.count == 0:
+                    continue
+                for bound, count in zip(histogram.bounds + ("+Inf",), histogram._cumulative()):
+                    samples.append(("_bucket", {"call_type": call_type, "le": bound}, count))
+                samples.append(("_sum", {"call_type": call_type}, histogram.sum))
+                samples.append(("_count", {"call_type": call_type}, histogram.count))
+            metric(name, "histogram", help_text, samples)
+
+        return "\n".join(lines) + "\n"
+
+    def _stats(self, calls, call_type):
+        stats = calls.get(call_type)
+        if stats is None:
+            stats = calls[call_type] = CallStats(self.buckets)
+        return stats
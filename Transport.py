@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+import openai
+from Cassette import CassetteMiss
+from Telemetry import Tracer
+
+# Priorities for the scheduler; lower values go first
+FOREGROUND = 0  # Calls the player is waiting on
+BACKGROUND = 1  # Bookkeeping that only affects future prompts
+
+# Call types that can wait behind narrative calls. Everything else runs in the foreground.
+CALL_PRIORITY = {
+    "update": BACKGROUND,
+    "summary": BACKGROUND
+}
+
+DEFAULT_MODELS = {"default": "gpt-4o-mini"}
+
+# Errors worth retrying; anything else (bad request, authentication, ...) will fail again the same way
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+
+
+class TransportError(Exception):
+    """Raised when a request could not be completed, even after retrying."""
+    def __init__(self, call_type, cause):
+        super().__init__(f"{call_type} request failed: {cause}")
+        self.call_type = call_type
+        self.cause = cause
+
+
+class Scheduler:
+    """Limits the requests in flight across every session sharing it, and optionally the request rate via a
+    token bucket. Waiting requests are admitted by priority, then in arrival order. A rate-limit response pauses
+    all new requests for the time the API asks for."""
+    def __init__(self, max_in_flight=16, rate=None, burst=None):
+        self.max_in_flight = max_in_flight
+        self.rate = rate  # Requests per second, or None for no limit
+        self.burst = burst if burst is not None else (rate or 0)
+
+        self.in_flight = 0
+        self._waiters = []  # Heap of (priority, sequence number, future)
+        self._sequence = itertools.count()
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority=FOREGROUND):
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            self.in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+            try:
+                await future  # The slot is handed over by release()
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()  # The slot arrived just as the request was cancelled
+                raise
+
+        try:
+            await self._take_token()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def pause(self, seconds):
+        """Holds back new requests, typically after the API reports a rate limit."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self.rate is None:
+                return
+
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Transport:
+    """Sends chat completion requests for GameManager. Picks the model by call type, queues requests on a
+    Scheduler, and retries transient failures with jittered exponential backoff. One Transport (and Scheduler)
+    is meant to be shared by every session in the process."""
+    def __init__(self, client, models=None, scheduler=None, timeout=60, max_retries=3, backoff=0.5, max_backoff=8,
+                 cassette=None, tracer=None):
+        # Retries are handled here, so that they go through the scheduler and honour its pauses
+        self._client = client.with_options(max_retries=0)
+        self.models = {**DEFAULT_MODELS, **(models or {})}
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cassette = cassette  # Records or replays every request (see Cassette)
+        self.tracer = tracer if tracer is not None else Tracer()
+
+    def model_for(self, call_type):
+        return self.models.get(call_type, self.models["default"])
+
+    async def complete(self, messages, call_type="default", session=None, **options):
+        """Returns the completion for the messages. Raises TransportError once retries are exhausted."""
+        span = self.tracer.start(call_type, session)
+        try:
+            response = await self._create(messages, call_type, session, options, span)
+        except BaseException as e:
+            self.tracer.finish(span, e)
+            raise
+        self.scheduler.release()
+
+        if response.usage is not None:
+            span.prompt_tokens = response.usage.prompt_tokens
+            span.completion_tokens = response.usage.completion_tokens
+        self.tracer.finish(span)
+        return response
+
+    async def stream(self, messages, call_type="default", session=None, **options):
+        """Yields the chunks of a streamed completion. Only opening the stream is retried, and the scheduler slot
+        is held until the stream has been consumed or closed."""
+        span = self.tracer.start(call_type, session)
+        error = None
+        text_length = 0
+        try:
+            stream = await self._create(messages, call_type, session,
+                                        {**options, "stream": True, "stream_options": {"include_usage": True}}, span)
+        except BaseException as e:
+            self.tracer.finish(span, e)
+            raise
+
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if span.first_token is None:
+                        span.first_token = time.perf_counter() - span.started
+                    text_length += len(chunk.choices[0].delta.content)
+                if getattr(chunk, "usage", None) is not None:
+                    span.prompt_tokens = chunk.usage.prompt_tokens
+                    span.completion_tokens = chunk.usage.completion_tokens
+                yield chunk
+        except openai.APIError as e:
+            error = TransportError(call_type, e)
+            raise error from e
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.scheduler.release()
+            if not span.prompt_tokens:
+                # Not every server reports usage on streams; fall back to a rough estimate
+                span.prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+                span.completion_tokens = text_length // 4
+            self.tracer.finish(span, error)
+
+    async def _create(self, messages, call_type, session, options, span):
+        """Sends the request, retrying transient failures. Returns with a scheduler slot held, which the caller
+        must release. No slot is held while backing off."""
+        priority = CALL_PRIORITY.get(call_type, FOREGROUND)
+        request = {"model": self.model_for(call_type), "messages": messages, **options}
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            await self.scheduler.acquire(priority)
+            span.queue_wait += time.perf_counter() - queued
+            span.attempts += 1
+            try:
+                if self.cassette is not None and self.cassette.replaying:
+                    return await self.cassette.replay(request, session)
+
+                started = time.perf_counter()
+                response = await self._client.chat.completions.create(timeout=self.timeout, **request)
+                if self.cassette is not None:
+                    response = self.cassette.record(request, response, started, session)
+                return response
+            except CassetteMiss as e:
+                self.scheduler.release()
+                raise TransportError(call_type, e) from e
+            except RETRYABLE_ERRORS as e:
+                self.scheduler.release()
+                if attempt >= self.max_retries:
+                    raise TransportError(call_type, e) from e
+
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if isinstance(e, openai.RateLimitError):
+                    retry_after = _retry_after(e)
+                    if retry_after is not None:
+                        delay = max(delay, retry_after)
+                    self.scheduler.pause(delay)  # Everyone else would hit the same limit
+                attempt += 1
+                await asyncio.sleep(delay)
+            except openai.APIError as e:
+                self.scheduler.release()
+                raise TransportError(call_type, e) from e
+            except BaseException:
+                self.scheduler.release()
+                raise
+
+
+def _retry_after(error):
+    """Reads the delay requested by a rate-limit response, if the API sent one."""
+    try:
+        return float(error.response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TurnBusy(RuntimeError):
+    """Raised when a turn is turned away: the queue is full, or the turn could not start before its deadline."""
+
+
+class Ticket:
+    """A turn's place in the TurnScheduler's queue."""
+    __slots__ = ("scheduler", "session_id", "deadline", "sequence", "state", "_changed")
+
+    def __init__(self, scheduler, session_id, deadline, sequence):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.deadline = deadline
+        self.sequence = sequence
+        self.state = "queued"  # Then "active" and "done", or "shed"
+        self._changed = asyncio.Event()
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+    @property
+    def position(self):
+        """Number of queued turns that will start before this one."""
+        return sum(1 for ticket in self.scheduler._queue if ticket.state == "queued" and ticket < self)
+
+    async def wait(self):
+        """Yields the ticket's position in the queue whenever it changes, and returns once the turn may start. Raises
+        TurnBusy if the deadline passes first."""
+        position = None
+        while self.state == "queued":
+            # Cleared before yielding, so that the turn being admitted while the caller is busy with the position
+            # is not missed
+            self._changed.clear()
+            if self.position != position:
+                position = self.position
+                yield position
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(self.deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.scheduler._shed(self)
+        if self.state == "shed":
+            raise TurnBusy("Timed out waiting for a turn to start")
+
+    def release(self):
+        """Ends the turn, or takes it out of the queue if it never started."""
+        self.scheduler._release(self)
+
+
+class TurnScheduler:
+    """Admits whole turns, so that a burst of players cannot flood the model API with every turn's requests at once.
+
+    At most max_active turns run at a time. Further turns wait in a queue of at most max_queued, ordered by deadline
+    (the time they were queued plus max_wait, unless given), and are turned away with TurnBusy rather than kept
+    waiting past it. Each session runs its turns one at a time (see SessionManager.turn), so a session holds at most
+    one place in the queue and every waiting player is served in turn."""
+    def __init__(self, max_active=64, max_queued=256, max_wait=30):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.active = 0
+        self._queue = []  # Heap of tickets by deadline
+        self._sequence = itertools.count()
+        self.stats = {"admitted": 0, "shed_full": 0, "shed_deadline": 0}
+
+    @property
+    def queued(self):
+        return sum(1 for ticket in self._queue if ticket.state == "queued")
+
+    def enqueue(self, session_id, max_wait=None):
+        """Queues a turn. Raises TurnBusy if the queue is full."""
+        if self.queued >= self.max_queued:
+            self.stats["shed_full"] += 1
+            raise TurnBusy("Too many turns waiting")
+        deadline = time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+        ticket = Ticket(self, session_id, deadline, next(self._sequence))
+        heapq.heappush(self._queue, ticket)
+        self._admit()
+        return ticket
+
+    def export_prometheus(self, prefix="cyoa"):
+        """Renders the queue's state in the Prometheus text exposition format."""
+        return "\n".join((
+            f"# HELP {prefix}_turns_active Turns running.",
+            f"# TYPE {prefix}_turns_active gauge",
+            f"{prefix}_turns_active {self.active}",
+            f"# HELP {prefix}_turns_queued Turns waiting to start.",
+            f"# TYPE {prefix}_turns_queued gauge",
+            f"{prefix}_turns_queued {self.queued}",
+            f"# HELP {prefix}_turns_admitted_total Turns started.",
+            f"# TYPE {prefix}_turns_admitted_total counter",
+            f"{prefix}_turns_admitted_total {self.stats['admitted']}",
+            f"# HELP {prefix}_turns_shed_total Turns turned away, by reason.",
+            f"# TYPE {prefix}_turns_shed_total counter",
+            f'{prefix}_turns_shed_total{{reason="full"}} {self.stats["shed_full"]}',
+            f'{prefix}_turns_shed_total{{reason="deadline"}} {self.stats["shed_deadline"]}'
+        )) + "\n"
+
+    def _admit(self):
+        now = time.monotonic()
+        while self._queue and self.active < self.max_active:
+            ticket = heapq.heappop(self._queue)
+            if ticket.state != "queued":
+                continue
+            if ticket.deadline <= now:
+                self._shed(ticket)
+                continue
+            ticket.state = "active"
+            self.active += 1
+            self.stats["admitted"] += 1
+            ticket._changed.set()
+        # Everyone still waiting has moved up
+        for ticket in self._queue:
+            ticket._changed.set()
+
+    def _shed(self, ticket):
+        if ticket.state == "queued":
+            ticket.state = "shed"
+            self.stats["shed_deadline"] += 1
+            ticket._changed.set()
+
+    def _release(self, ticket):
+        if ticket.state == "active":
+            self.active -= 1
+        ticket.state = "done"
+        self._admit()
@@ -0,0 +1,220 @@
+def normalize(name):
+    """Key used to look up entities, so that names differing only in case or spacing match."""
+    return " ".join(name.split()).casefold()
+
+
+class Entity:
+    """Anything in the story that is known by name."""
+    __slots__ = ("name", "description")
+    fields = ("name", "description")
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+    @property
+    def key(self):
+        return normalize(self.name)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*(data[field] for field in cls.fields))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+
+class Item(Entity):
+    __slots__ = ("location",)
+    fields = ("name", "description", "location")
+
+    def __init__(self, name, description, location):
+        super().__init__(name, description)
+        self.location = location
+
+
+class Location(Entity):
+    __slots__ = ("area",)
+    fields = ("name", "description", "area")
+
+    def __init__(self, name, description, area):
+        super().__init__(name, description)
+        self.area = area
+
+
+class Character(Entity):
+    __slots__ = ("location",)
+    fields = ("name", "description", "location")
+
+    def __init__(self, name, description, location):
+        super().__init__(name, description)
+        self.location = location
+
+
+class InventoryItem(Entity):
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        # Some authored stories key inventory items by "item" rather than "name"
+        return cls(data.get("name", data.get("item", "Unknown")), data["description"])
+
+
+class Player(Entity):
+    __slots__ = ("location",)
+    fields = ("name", "description", "location")
+
+    def __init__(self, name, description, location):
+        super().__init__(name, description)
+        self.location = location
+
+
+class EntityIndex:
+    """Name-keyed collection of entities. Keeps insertion order, and indexes entities by location if they have one."""
+    def __init__(self, entities=()):
+        self._entities = {}
+        self._by_location = {}  # Normalized location -> keys of the entities there, as an ordered set
+        self.version = 0  # Incremented on every change, so that derived data (such as rendered text) can be cached
+        self._shared = False  # Whether the dicts above are shared with a fork, and must be copied before a change
+        for entity in entities:
+            self.upsert(entity)
+
+    def fork(self):
+        """Returns a copy of the index. The two share their storage (and entities, which are never changed in place)
+        until either of them is changed."""
+        copy = EntityIndex.__new__(EntityIndex)
+        copy._entities = self._entities
+        copy._by_location = self._by_location
+        copy.version = self.version
+        copy._shared = self._shared = True
+        return copy
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self):
+        return iter(self._entities.values())
+
+    def __contains__(self, name):
+        return normalize(name) in self._entities
+
+    def get(self, name):
+        return self._entities.get(normalize(name))
+
+    def upsert(self, entity):
+        """Adds the entity, or replaces the existing entity of the same name in place. Returns the replaced entity."""
+        self._own()
+        key = entity.key
+        previous = self._entities.get(key)
+        if previous is not None:
+            self._unindex(key, previous)
+        self._entities[key] = entity
+        self._index(key, entity)
+        self.version += 1
+        return previous
+
+    def remove(self, name):
+        """Removes and returns the entity with the given name, or None if there is no such entity."""
+        key = normalize(name)
+        if key not in self._entities:
+            return None
+        self._own()
+        entity = self._entities.pop(key)
+        self._unindex(key, entity)
+        self.version += 1
+        return entity
+
+    def items(self):
+        """Returns (key, entity) pairs in insertion order."""
+        return self._entities.items()
+
+    def at_location(self, location):
+        """Returns the entities whose location matches the given name."""
+        return [self._entities[key] for key in self._by_location.get(normalize(location), ())]
+
+    def _own(self):
+        if self._shared:
+            self._entities = dict(self._entities)
+            self._by_location = {location: dict(keys) for location, keys in self._by_location.items()}
+            self._shared = False
+
+    def _index(self, key, entity):
+        location = getattr(entity, "location", None)
+        if location is not None:
+            self._by_location.setdefault(normalize(location), {})[key] = None
+
+    def _unindex(self, key, entity):
+        location = getattr(entity, "location", None)
+        if location is not None:
+            keys = self._by_location.get(normalize(location))
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self._by_location[normalize(location)]
+
+
+class WorldState:
+    """Everything the story knows about its world: the player, their inventory, the map, objects, and characters."""
+    def __init__(self, player, setting, locations=(), items=(), characters=(), inventory=()):
+        self.player = player
+        self.setting = setting  # Name of the map
+        self.locations = EntityIndex(locations)
+        self.items = EntityIndex(items)
+        self.characters = EntityIndex(characters)
+        self.inventory = EntityIndex(inventory)
+
+    @classmethod
+    def from_story(cls, story):
+        """Builds the world state from a story (or exported state) in the story_data.json format."""
+        return cls(
+            Player.from_dict(story["player"]),
+            story["map"]["name"],
+            locations=[Location.from_dict(location) for location in story["map"]["locations"]],
+            items=[Item.from_dict(item) for item in story["objects"]],
+            characters=[Character.from_dict(character) for character in story["characters"]],
+            inventory=[InventoryItem.from_dict(item) for item in story["player"]["inventory"]]
+        )
+
+    def fork(self):
+        """Returns a copy of the world state that shares everything with this one until it is changed. Used to start
+        games from a story's template world without copying it."""
+        world = WorldState.__new__(WorldState)
+        world.player = self.player
+        world.setting = self.setting
+        world.locations = self.locations.fork()
+        world.items = self.items.fork()
+        world.characters = self.characters.fork()
+        world.inventory = self.inventory.fork()
+        return world
+
+    def to_dict(self):
+        """Returns the world state in the story_data.json format."""
+        player = self.player.to_dict()
+        player["inventory"] = [item.to_dict() for item in self.inventory]
+        return {
+            "player": player,
+            "map": {"name": self.setting, "locations": [location.to_dict() for location in self.locations]},
+            "objects": [item.to_dict() for item in self.items],
+            "characters": [character.to_dict() for character in self.characters]
+        }
+
+    def entities_at(self, location):
+        """Returns the objects and characters found at a location."""
+        return self.items.at_location(location) + self.characters.at_location(location)
+
+    def apply(self, updates):
+        """Merges a list of checked updates (see GameManager._check_update) into the world state."""
+        for update in updates:
+            mode, data = update["mode"], update["update"]
+            if mode == "item":
+                self.items.upsert(Item.from_dict(data))
+            elif mode == "location":
+                self.locations.upsert(Location.from_dict(data))
+            elif mode == "character":
+                self.characters.upsert(Character.from_dict(data))
+            elif mode == "player-item-add":
+                for item in data["items"]:
+                    self.inventory.upsert(InventoryItem.from_dict(item))
+            elif mode == "player-item-remove":
+                for name in data["items"]:
+                    self.inventory.remove(name)
@@ -0,0 +1,223 @@
+"""Drives simulated players through GameManager and reports turn latency and throughput.
+
+Without --base-url, a mock OpenAI server (benchmarks.mock_openai) is started in a subprocess, and any mock
+options given here are passed on to it. With --cassette, every request is recorded to (or replayed from) a
+cassette file, which makes runs against captured model output reproducible. Run from the repository root:
+
+    python -m benchmarks.loadtest --players 200 --turns 5 --stream --latency lognormal:0.4,0.5
+    python -m benchmarks.loadtest --base-url https://api.openai.com/v1 --api-key $OPENAI_API_KEY --seed 1 --cassette run.jsonl.gz --cassette-mode record
+    python -m benchmarks.loadtest --seed 1 --cassette run.jsonl.gz --cassette-mode replay --replay-latency-scale 1
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import socket
+import subprocess
+import sys
+import time
+from openai import AsyncOpenAI
+from Cassette import Cassette
+from ActionValidator import ActionValidator
+from GameManager import GameManager
+from ResponseCache import ResponseCache
+from StoryCatalog import StoryCatalog
+from Transport import Transport, Scheduler, TransportError
+from TurnScheduler import TurnScheduler, TurnBusy
+from benchmarks import mock_openai
+
+ACTIONS = [
+    "I look around the shack for something to patch the boat with.",
+    "I pick up the hammer from the toolshelf.",
+    "I open the rattling cabinet.",
+    "I walk down to the dock and inspect the hole in the boat.",
+    "I nail a plank over the hole.",
+    "I read the old tome by the light of the lantern.",
+    "I tie the rope to the dock post.",
+    "I cast a line off the end of the dock to test the rod."
+]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+class Results:
+    def __init__(self):
+        self.turns = []  # Seconds per turn
+        self.first_tokens = []  # Seconds until the first outcome text, when streaming
+        self.conclusions = []
+        self.errors = 0
+        self.busy = 0  # Turns turned away by the turn scheduler
+
+    def report(self, elapsed, players):
+        lines = [f"players: {players}, turns completed: {len(self.turns)}, errors: {self.errors}, busy: {self.busy}, "
+                 f"wall time: {elapsed:.2f}s",
+                 f"throughput: {len(self.turns) / elapsed:.2f} turns/s"]
+        for name, values in (("turn latency", self.turns), ("time to first token", self.first_tokens),
+                             ("conclusion latency", self.conclusions)):
+            if values:
+                lines.append(f"{name}: p50 {percentile(values, 0.5):.3f}s  p95 {percentile(values, 0.95):.3f}s  "
+                             f"p99 {percentile(values, 0.99):.3f}s  max {max(values):.3f}s")
+        return "\n".join(lines)
+
+
+async def take_turn(gm, action, args, results, start):
+    if args.stream:
+        first_token = None
+        async for _ in gm.stream_action(action):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        results.first_tokens.append(first_token)
+    else:
+        await gm.next_action(action)
+
+
+async def play(player, transport, story_data, args, results, prevalidator, response_cache, turns):
+    """One simulated player: start a game, take every turn, and request the conclusion."""
+    # Each player draws from its own generator, so that a seeded run picks the same actions however turns interleave
+    rng = random.Random(None if args.seed is None else args.seed + player)
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    gm = GameManager(transport=transport, story_data=story_data, turn_limit=args.turns, speculative=args.speculative,
+                     session_id=f"player-{player}", prevalidator=prevalidator, response_cache=response_cache,
+                     world_lag=args.world_lag)
+    gm.select_game(player % len(story_data))
+
+    while gm.action_number > 0:
+        action = rng.choice(ACTIONS)
+        start = time.perf_counter()
+        try:
+            if turns is None:
+                await take_turn(gm, action, args, results, start)
+            else:
+                ticket = turns.enqueue(gm.session_id)
+                try:
+                    async for _ in ticket.wait():
+                        pass
+                    await take_turn(gm, action, args, results, start)
+                finally:
+                    ticket.release()
+        except TransportError:
+            results.errors += 1
+            continue
+        except TurnBusy:
+            results.busy += 1
+            await asyncio.sleep(max(args.think, 1.0))  # A player told to come back later does not do so at once
+            continue
+        results.turns.append(time.perf_counter() - start)
+        await asyncio.sleep(args.think)
+
+    start = time.perf_counter()
+    try:
+        await gm.generate_conclusion()
+        results.conclusions.append(time.perf_counter() - start)
+    except TransportError:
+        results.errors += 1
+
+
+async def run(args, base_url):
+    story_data = StoryCatalog("story_data.json")
+    client = AsyncOpenAI(api_key=args.api_key, base_url=base_url)
+    cassette = None
+    if args.cassette:
+        cassette = Cassette(args.cassette, args.cassette_mode, args.replay_latency_scale)
+    transport = Transport(client, scheduler=Scheduler(max_in_flight=args.max_in_flight, rate=args.rate),
+                          cassette=cassette)
+    results = Results()
+    prevalidator = ActionValidator() if args.prevalidate else None
+    response_cache = ResponseCache() if args.response_cache else None
+    turns = None
+    if args.max_active_turns:
+        turns = TurnScheduler(max_active=args.max_active_turns, max_queued=args.max_queued_turns,
+                              max_wait=args.max_turn_wait)
+
+    start = time.perf_counter()
+    # GameManager reports progress with print; keep it out of the report unless asked for
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        await asyncio.gather(*(play(player, transport, story_data, args, results, prevalidator, response_cache, turns) for player in range(args.players)))
+    elapsed = time.perf_counter() - start
+    if cassette is not None:
+        cassette.close()
+
+    print(results.report(elapsed, args.players))
+    if response_cache is not None:
+        for layer, stats in sorted(response_cache.stats().items()):
+            print(f"response cache ({layer}): {stats['hits']} hits, {stats['misses']} misses, "
+                  f"hit rate {stats['hit_rate']:.0%}")
+    if args.speculative:
+        speculation = transport.tracer.dump_histograms().get("turn", {}).get("speculation")
+        if speculation:
+            print(f"speculation: {speculation['kept']} turns kept a branch, {speculation['discarded']} discarded, "
+                  f"{speculation['latency_saved']:.2f}s saved, {speculation['tokens_wasted']} tokens wasted")
+    return results
+
+
+def start_mock_server(args):
+    """Starts the mock server in its own process, so it does not compete with the players for the event loop."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, "-m", "benchmarks.mock_openai", "--port", str(port), "--latency", args.latency,
+               "--tokens-per-second", str(args.tokens_per_second), "--reply-tokens", str(args.reply_tokens),
+               "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+               "--retry-after", str(args.retry_after)]
+    if args.update_reply:
+        command += ["--update-reply", args.update_reply]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()  # Wait for the listening message
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=50, help="Number of simulated players")
+    parser.add_argument("--turns", type=int, default=5, help="Actions per game")
+    parser.add_argument("--ramp", type=float, default=1.0, help="Players start at random times within this many seconds")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds each player waits between turns")
+    parser.add_argument("--stream", action="store_true", help="Use stream_action instead of next_action")
+    parser.add_argument("--speculative", action="store_true", help="Enable speculative outcome generation")
+    parser.add_argument("--prevalidate", action="store_true", help="Settle clear-cut actions with the local validator")
+    parser.add_argument("--response-cache", action="store_true", help="Reuse validity and consistency verdicts")
+    parser.add_argument("--world-lag", type=int, default=0,
+                        help="Turns whose world state updates a prompt may go without")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Scheduler limit on concurrent requests")
+    parser.add_argument("--rate", type=float, help="Scheduler limit on requests per second")
+    parser.add_argument("--max-active-turns", type=int, help="Admit turns through a TurnScheduler running this many at once")
+    parser.add_argument("--max-queued-turns", type=int, default=256, help="Turns the TurnScheduler lets wait")
+    parser.add_argument("--max-turn-wait", type=float, default=30, help="Seconds a turn may wait before it is turned away")
+    parser.add_argument("--base-url", help="Use an already running server instead of starting the mock")
+    parser.add_argument("--api-key", default="mock", help="API key for --base-url")
+    parser.add_argument("--cassette", help="File to record requests to, or replay them from")
+    parser.add_argument("--cassette-mode", choices=("record", "replay"), default="replay")
+    parser.add_argument("--replay-latency-scale", type=float, default=0.0,
+                        help="Fraction of the recorded latency to simulate when replaying")
+    parser.add_argument("--verbose", action="store_true", help="Show GameManager's output")
+    mock_openai.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    process = None
+    base_url = args.base_url
+    if args.cassette and args.cassette_mode == "replay":
+        base_url = base_url or "http://127.0.0.1:9/v1"  # Never contacted
+    elif base_url is None:
+        process, base_url = start_mock_server(args)
+    try:
+        asyncio.run(run(args, base_url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Local stand-in for OpenAI's chat completions endpoint, for exercising GameManager without the real API.
+
+Replies are picked from the system prompt: validation gets "Valid", consistency checks get "Consistent", world
+state updates get a canned json update, and everything else gets filler prose. Latency, throughput, and error
+rates are configurable.
+
+    python -m benchmarks.mock_openai --port 8765 --latency lognormal:0.4,0.5 --tokens-per-second 80 --rate-limit-rate 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+
+FILLER = ("The wind picks up over the water as the reeds bend and whisper. Moe wipes his hands on his overalls and "
+          "takes stock of what he has to work with, muttering to himself about the long night ahead. ")
+
+
+def parse_distribution(spec):
+    """Parses a latency distribution such as "fixed:0.5", "uniform:0.2,1.0", "normal:0.5,0.1", or
+    "lognormal:0.4,0.5" (median in seconds, sigma). Returns a function producing samples in seconds."""
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockBehaviour:
+    """How the mock server responds."""
+    def __init__(self, latency="lognormal:0.4,0.5", tokens_per_second=80.0, reply_tokens=120, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1.0, update_reply=None):
+        self.latency = parse_distribution(latency)  # Time to first token
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens  # Length of filler replies
+        self.error_rate = error_rate  # Fraction of requests answered with a 500
+        self.rate_limit_rate = rate_limit_rate  # Fraction of requests answered with a 429
+        self.retry_after = retry_after
+        self.update_reply = update_reply  # Canned world update json; generated if None
+        self._ids = itertools.count()
+
+    def reply_for(self, request):
+        """Returns the text the model would produce for the request."""
+        messages = request.get("messages", [])
+        system = messages[0]["content"] if messages else ""
+        if "check if it is allowed" in system:
+            return "Valid"
+        if "Output 'Consistent'" in system:
+            return "Consistent"
+        if request.get("response_format"):
+            return self.update_reply if self.update_reply is not None else self._generated_update()
+        words = FILLER.split(" ")
+        return " ".join(itertools.islice(itertools.cycle(words), self.reply_tokens))
+
+    def _generated_update(self):
+        # New entities every time, so that the world state grows as it would in a long game
+        n = next(self._ids)
+        return json.dumps({"updates": [
+            {"mode": "item", "update": {"name": f"Driftwood Plank {n}", "description": "A waterlogged plank.", "location": "The Lakeshore"}},
+            {"mode": "character", "update": {"name": f"Heron {n}", "description": "A patient grey heron.", "location": "The Lakeshore"}},
+            {"mode": "player-item-add", "update": {"items": [{"name": f"Bent Nail {n}", "description": "A rusty nail."}]}}
+        ]})
+
+
+def completion_body(request, text, prompt_tokens):
+    completion_tokens = len(text) // 4 + 1
+    return {
+        "id": f"chatcmpl-mock-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+
+def chunk_body(request, completion_id, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+
+class MockServer:
+    """Minimal HTTP/1.1 server (with keep-alive and chunked streaming) implementing POST /v1/chat/completions."""
+    def __init__(self, behaviour, host="127.0.0.1", port=8765):
+        self.behaviour = behaviour
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Mock OpenAI server listening on http://{self.host}:{self.port}/v1")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if method != "POST" or not path.rstrip("/").endswith("/chat/completions"):
+                    await self._send_json(writer, 404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+                else:
+                    await self._complete(writer, json.loads(body))
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _complete(self, writer, request):
+        self.requests += 1
+        behaviour = self.behaviour
+        await asyncio.sleep(behaviour.latency())
+
+        roll = random.random()
+        if roll < behaviour.rate_limit_rate:
+            await self._send_json(writer, 429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                                  {"retry-after": str(behaviour.retry_after)})
+            return
+        if roll < behaviour.rate_limit_rate + behaviour.error_rate:
+            await self._send_json(writer, 500, {"error": {"message": "Internal error", "type": "server_error"}})
+            return
+
+        text = behaviour.reply_for(request)
+        prompt_tokens = len(json.dumps(request.get("messages", []))) // 4 + 1
+        seconds_per_token = 1 / behaviour.tokens_per_second if behaviour.tokens_per_second else 0
+
+        if not request.get("stream"):
+            await asyncio.sleep(seconds_per_token * (len(text) // 4 + 1))
+            await self._send_json(writer, 200, completion_body(request, text, prompt_tokens))
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        completion_id = f"chatcmpl-mock-{random.getrandbits(48):x}"
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)]  # Roughly four tokens per chunk
+        events = [chunk_body(request, completion_id, {"role": "assistant", "content": ""})]
+        events += [chunk_body(request, completion_id, {"content": piece}) for piece in pieces]
+        events.append(chunk_body(request, completion_id, {}, "stop"))
+        for i, event in enumerate(events):
+            if 1 < i < len(events) - 1:
+                await asyncio.sleep(seconds_per_token * 4)
+            self._write_chunk(writer, f"data: {json.dumps(event)}\n\n".encode())
+            await writer.drain()
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _write_chunk(writer, data):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    @staticmethod
+    async def _send_json(writer, status, body, headers=None):
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}[status]
+        data = json.dumps(body).encode()
+        extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n{extra}\r\n".encode() + data)
+        await writer.drain()
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", default="lognormal:0.4,0.5", help="Time-to-first-token distribution")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="Completion throughput per request")
+    parser.add_argument("--reply-tokens", type=int, default=120, help="Length of generated prose replies")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with 429 responses")
+    parser.add_argument("--update-reply", help="File holding a canned json reply for world state updates")
+    parser.add_argument("--seed", type=int, help="Seed for latency and error sampling")
+
+
+def behaviour_from_args(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+    update_reply = None
+    if args.update_reply:
+        with open(args.update_reply, "r") as f:
+            update_reply = f.read()
+    return MockBehaviour(args.latency, args.tokens_per_second, args.reply_tokens, args.error_rate,
+                         args.rate_limit_rate, args.retry_after, update_reply)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    asyncio.run(MockServer(behaviour_from_args(args), args.host, args.port).serve_forever())
@@ -0,0 +1,330 @@
+"""Times the parts of a game that run without the model, so that changes to the world state model and prompt rendering
+are measured rather than guessed.
+
+Covered: rendering the Story Information section at 10, 100, and 1000 entities; assembling prompts with long
+stories; decoding and merging world updates; select_game on large catalogs; and the memory held per session. Every
+benchmark runs on generated stories, so results do not depend on story_data.json. Run from the repository root:
+
+    python -m benchmarks.offline
+    python -m benchmarks.offline --filter status --compare benchmarks/results/<commit>.json
+
+Results are written to benchmarks/results/<commit>.json (with a -dirty suffix if the tree has uncommitted changes),
+so that runs on different commits can be compared with --compare. Compare runs from the same machine.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from openai import AsyncOpenAI
+from GameManager import GameManager
+from StoryCatalog import StoryCatalog
+from StoryStatus import StatusRenderer
+from Transport import Transport
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+SENTENCE = "The old planks creak underfoot while gulls circle over the murky water of the lake. "
+WORDS = SENTENCE.split() + ["Moe", "boat", "hammer", "storm", "lantern", "dock", "rope", "heron", "nail", "shack"]
+
+
+def prose(seed, words):
+    """Varied text, so that compressed sizes are not flattered by repetition."""
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+
+def make_story(title, entities):
+    """Generates a story in the story_data.json format with about the given number of entities: a fifth each
+    locations, characters, and inventory items, and the rest objects."""
+    locations = max(entities // 5, 1)
+    characters = inventory = entities // 5
+    objects = entities - locations - characters - inventory
+    location_names = [f"{title} Location {i}" for i in range(locations)]
+    return {
+        "title": title,
+        "introduction": SENTENCE * 8,
+        "conclusion": SENTENCE * 3,
+        "player": {"name": "Moe", "description": SENTENCE, "location": location_names[0],
+                   "inventory": [{"name": f"Tool {i}", "description": SENTENCE} for i in range(inventory)]},
+        "map": {"name": f"{title} Surroundings",
+                "locations": [{"name": name, "description": SENTENCE * 2, "area": f"North of {location_names[i - 1]}"}
+                              for i, name in enumerate(location_names)]},
+        "objects": [{"name": f"Object {i}", "description": SENTENCE, "location": location_names[i % locations]}
+                    for i in range(objects)],
+        "characters": [{"name": f"Character {i}", "description": SENTENCE, "location": location_names[i % locations]}
+                       for i in range(characters)]
+    }
+
+
+def make_updates(count):
+    """World update json as the model returns it, mixing every mode and both new and existing entities."""
+    updates = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            updates.append({"mode": "item", "update": {"name": f"Object {i}", "description": SENTENCE,
+                                                        "location": "Story Location 0"}})
+        elif kind == 1:
+            updates.append({"mode": "location", "update": {"name": f"New Location {i}", "description": SENTENCE,
+                                                            "area": "Beside the lake"}})
+        elif kind == 2:
+            updates.append({"mode": "character", "update": {"name": f"Character {i}", "description": SENTENCE,
+                                                             "location": "Story Location 1"}})
+        elif kind == 3:
+            updates.append({"mode": "player-item-add", "update": {"items": [{"name": f"Found {i}",
+                                                                              "description": SENTENCE}]}})
+        else:
+            updates.append({"mode": "player-item-remove", "update": {"items": [f"Tool {i % 3}"]}})
+    return json.dumps({"updates": updates})
+
+
+def new_game_manager(catalog, transport):
+    return GameManager(transport=transport, story_data=catalog, turn_limit=10000, session_id="bench")
+
+
+def play(gm, turns, updates_per_turn=2):
+    """Plays turns without the model, through the same replay path that restores games from the journal."""
+    for i in range(turns):
+        gm.replay({"action": prose(2 * i, 15), "output": prose(2 * i + 1, 60), "updates": []})
+        gm._merge_updates(json.loads(make_updates(updates_per_turn))["updates"])
+
+
+def measure(fn, repeat, min_time):
+    """Times fn like timeit: calls it in batches big enough to take min_time seconds, repeat times. Returns the
+    seconds per call of each batch."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(int(min_time / elapsed * 1.2), 10))
+
+    times = [elapsed / number]
+    gc_enabled = gc.isenabled()
+    gc.disable()  # Collections landing in one batch but not another only add noise
+    try:
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return times
+
+
+def selected(args, *names):
+    """Whether any of the benchmarks named is wanted, so that suites only build the fixtures of those that are."""
+    return not args.filter or any(pattern in name for name in names for pattern in args.filter)
+
+
+def timing(times):
+    return {"unit": "s", "median": statistics.median(times), "min": min(times), "runs": len(times)}
+
+
+def bench_status(transport, args):
+    for entities in (10, 100, 1000):
+        if not selected(args, *(f"status.render.{kind}.{entities}" for kind in ("cold", "warm", "one_change"))):
+            continue
+        catalog = StoryCatalog.from_stories([make_story("Story", entities)])
+        gm = new_game_manager(catalog, transport)
+        gm.select_game(0)
+        world = gm.world
+
+        # Cold: a fresh renderer, as after a game is restored
+        yield f"status.render.cold.{entities}", lambda: StatusRenderer(world, gm._conclusion).render()
+        # Warm: nothing changed since the last prompt
+        yield f"status.render.warm.{entities}", lambda: gm.get_story_status()
+
+        # One entity changed since the last prompt, as after a typical turn
+        def changed(gm=gm, counter=[0]):
+            counter[0] += 1
+            gm.world.apply([{"mode": "item", "update": {"name": "Object 0", "description": f"Moved {counter[0]}",
+                                                          "location": "Story Location 0"}}])
+            gm.get_story_status()
+        yield f"status.render.one_change.{entities}", changed
+
+
+def bench_prompts(transport, args):
+    catalog = StoryCatalog.from_stories([make_story("Story", 100)])
+    for turns in (10, 100, 1000):
+        if not selected(args, *(f"prompt.{kind}.{turns}_turns" for kind in ("outcome", "consistency", "context"))):
+            continue
+        gm = new_game_manager(catalog, transport)
+        gm.select_game(0)
+        play(gm, turns, updates_per_turn=0)
+        action = "I row the boat out to the middle of the lake."
+        yield f"prompt.outcome.{turns}_turns", lambda gm=gm: gm._outcome_messages(action)
+        yield f"prompt.consistency.{turns}_turns", lambda gm=gm: gm._consistency_messages(action)
+        yield f"prompt.context.{turns}_turns", lambda gm=gm: gm._context.render(gm.current_story)
+
+
+def bench_updates(transport, args):
+    if not selected(args, *(f"updates.{kind}.{count}" for kind in ("decode", "decode_merge") for count in (5, 50))):
+        return
+    catalog = StoryCatalog.from_stories([make_story("Story", 100)])
+    gm = new_game_manager(catalog, transport)
+    gm.select_game(0)
+    for count in (5, 50):
+        content = make_updates(count)
+        yield f"updates.decode.{count}", lambda content=content: gm._decode_updates(content)
+
+        # Merged into a fresh fork of the story's world each time, so that every run pays for the copy on write
+        def merge(content=content):
+            world = catalog.world(0)
+            gm.world, template = world, gm.world
+            try:
+                gm._merge_updates(gm._decode_updates(content))
+            finally:
+                gm.world = template
+        yield f"updates.decode_merge.{count}", merge
+
+
+def bench_catalog(transport, args):
+    with tempfile.TemporaryDirectory(prefix="cyoa-bench-") as directory:
+        for stories in (100, 1000):
+            if not selected(args, f"catalog.build_index.{stories}", f"catalog.open.{stories}",
+                            f"select_game.cold.{stories}", f"select_game.warm.{stories}"):
+                continue
+            path = os.path.join(directory, f"catalog-{stories}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump([make_story(f"Story {i}", 50) for i in range(stories)], f)
+
+            def build_index(path=path):
+                os.remove(path + ".index")
+                StoryCatalog(path).close()
+            StoryCatalog(path).close()
+            yield f"catalog.build_index.{stories}", build_index
+            yield f"catalog.open.{stories}", lambda path=path: StoryCatalog(path).close()
+
+            catalog = StoryCatalog(path, cache_size=64)
+            gm = new_game_manager(catalog, transport)
+
+            # Cycling through every story misses the cache of parsed stories, as when players spread over the
+            # catalog
+            def select_cold(gm=gm, counter=[0]):
+                counter[0] = (counter[0] + 1) % stories
+                gm.current_story.clear()
+                gm.select_game(counter[0])
+            yield f"select_game.cold.{stories}", select_cold
+
+            def select_warm(gm=gm):
+                gm.current_story.clear()
+                gm.select_game(0)
+            yield f"select_game.warm.{stories}", select_warm
+            catalog.close()
+
+
+def bench_memory(transport, args):
+    """Bytes held per session, live and frozen (see SessionManager), rather than times."""
+    catalog = StoryCatalog.from_stories([make_story("Story", 100)])
+    new_game_manager(catalog, transport).select_game(0)  # Parses the story outside the measurement
+    for turns in (0, 10):
+        if not selected(args, f"memory.session.{turns}_turns", f"memory.frozen_session.{turns}_turns"):
+            continue
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        games = []
+        for _ in range(args.sessions):
+            gm = new_game_manager(catalog, transport)
+            gm.select_game(0)
+            play(gm, turns)
+            games.append(gm)
+        gc.collect()
+        live = (tracemalloc.get_traced_memory()[0] - before) / args.sessions
+        tracemalloc.stop()
+
+        frozen = statistics.mean(len(zlib.compress(json.dumps(gm.export_state(), separators=(",", ":"))
+                                                   .encode("utf-8"))) for gm in games)
+        yield f"memory.session.{turns}_turns", {"unit": "bytes", "value": live}
+        yield f"memory.frozen_session.{turns}_turns", {"unit": "bytes", "value": frozen}
+
+
+SUITES = (bench_status, bench_prompts, bench_updates, bench_catalog, bench_memory)
+
+
+def run(args):
+    transport = Transport(AsyncOpenAI(api_key="offline", base_url="http://127.0.0.1:9/v1"))
+    results = {}
+    for suite in SUITES:
+        for name, benchmark in suite(transport, args):
+            if not selected(args, name):
+                continue
+            if callable(benchmark):
+                benchmark = timing(measure(benchmark, args.repeat, args.min_time))
+            results[name] = benchmark
+            print(format_result(name, benchmark), flush=True)
+    return results
+
+
+def format_result(name, result, baseline=None):
+    if result["unit"] == "bytes":
+        text = f"{name:45} {result['value'] / 1024:10.1f} KiB"
+        value, previous = result["value"], baseline and baseline.get("value")
+    else:
+        text = f"{name:45} {result['median'] * 1e6:10.1f} us  (min {result['min'] * 1e6:.1f} us)"
+        value, previous = result["median"], baseline and baseline.get("median")
+    if previous:
+        text += f"  {value / previous:6.2f}x baseline"
+    return text
+
+
+def revision():
+    """Returns the current commit, with -dirty if the tree has uncommitted changes, or "unknown" outside git."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + "-dirty" if dirty else commit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", action="append", help="Only run benchmarks whose name contains this (repeatable)")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed batches per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.05, help="Seconds each timed batch runs for")
+    parser.add_argument("--sessions", type=int, default=200, help="Sessions created to measure memory per session")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against")
+    parser.add_argument("--output", help="Where to write the results (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--no-save", action="store_true", help="Print the results without writing them")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {baseline['revision']} ({baseline['date']}):")
+        for name, result in results.items():
+            print(format_result(name, result, baseline["results"].get(name)))
+
+    if not args.no_save:
+        rev = revision()
+        output = args.output or os.path.join(RESULTS_DIR, f"{rev}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"revision": rev, "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                       "python": sys.version.split()[0], "platform": platform.platform(),
+                       "results": results}, f, indent=1)
+        print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Runs several game workers (each a separate userint.py process, with its own event loop) behind one port.
+
+A small TCP proxy listens on the public port and sends every connection from the same client address to the same
+worker, so a player's page, queue, and streaming connections all land in one process. Games are kept in a shared
+SQLite session store, and turns are played under a lease on the session, so a player whose connections do move
+(because a worker restarted, say) carries on from where they were, and two turns of one game never run at once.
+
+    python multiworker.py --workers 4 --port 7860
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+
+
+class StickyProxy:
+    """Forwards connections to the workers, picking the worker from a hash of the client's address. If that worker
+    is not accepting connections, the next one is tried."""
+    def __init__(self, worker_ports, host="127.0.0.1", port=7860, worker_host="127.0.0.1"):
+        self.worker_ports = worker_ports
+        self.host = host
+        self.port = port
+        self.worker_host = worker_host
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Proxying http://{self.host}:{self.port} to {len(self.worker_ports)} workers")
+        async with server:
+            await server.serve_forever()
+
+    def _pick(self, client_host):
+        digest = hashlib.blake2b(client_host.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % len(self.worker_ports)
+
+    async def _handle(self, client_reader, client_writer):
+        client_host = client_writer.get_extra_info("peername")[0]
+        first = self._pick(client_host)
+        worker = None
+        for i in range(len(self.worker_ports)):
+            port = self.worker_ports[(first + i) % len(self.worker_ports)]
+            try:
+                worker = await asyncio.open_connection(self.worker_host, port)
+                break
+            except OSError:
+                continue
+        if worker is None:
+            client_writer.close()
+            return
+
+        worker_reader, worker_writer = worker
+        await asyncio.gather(self._pipe(client_reader, worker_writer), self._pipe(worker_reader, client_writer))
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def start_workers(count, first_port, session_db):
+    workers = []
+    for i in range(count):
+        env = dict(os.environ, GRADIO_SERVER_PORT=str(first_port + i), CYOA_WORKER_ID=f"worker-{i}",
+                   CYOA_SESSION_DB=session_db)
+        workers.append(subprocess.Popen([sys.executable, "userint.py"], env=env))
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the proxy listens on")
+    parser.add_argument("--port", type=int, default=7860, help="Port the proxy listens on")
+    parser.add_argument("--worker-port", type=int, default=7861, help="Port of the first worker; the rest follow it")
+    parser.add_argument("--session-db", default="sessions.db", help="SQLite database shared by the workers")
+    args = parser.parse_args()
+
+    workers = start_workers(args.workers, args.worker_port, args.session_db)
+    proxy = StickyProxy([args.worker_port + i for i in range(args.workers)], args.host, args.port)
+    try:
+        asyncio.run(proxy.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
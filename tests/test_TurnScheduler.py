@@ -0,0 +1,27 @@
+import asyncio
+import time
+import unittest
+from TurnScheduler import TurnScheduler
+
+
+class TicketWaitTest(unittest.TestCase):
+    def test_admitted_while_caller_handles_position(self):
+        async def scenario():
+            scheduler = TurnScheduler(max_active=1, max_wait=5)
+            first = scheduler.enqueue("first")
+            second = scheduler.enqueue("second")
+            start = time.monotonic()
+            async for position in second.wait():
+                # The first turn ends while the caller is busy sending the position, as Gradio is
+                self.assertEqual(position, 0)
+                first.release()
+                await asyncio.sleep(0)
+            return time.monotonic() - start, second.state
+
+        elapsed, state = asyncio.run(scenario())
+        self.assertEqual(state, "active")
+        self.assertLess(elapsed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
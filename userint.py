@@ -1,67 +1,246 @@
+import os
 import gradio as gr
-import json
-import asyncio
-from GameManager import GameManager
-
-# Load story data
-with open("story_data.json", "r") as f:
-    story_data = json.load(f)
-
-gm = GameManager(api_key="key")
-
-current_story_index = 0
-game_over = False
-
-async def start_game():
-    global game_over
-
-    gm.select_game(current_story_index)
-    game_over = False
-    return "\n\n".join(gm.current_story), gm.get_story_status(conclusion=False)
-
-async def next_action(action):
-    global game_over
-
-    if game_over:
-        await gm.generate_conclusion()
-        return "\n\n".join(gm.current_story), gr.update(value=""), gr.update()
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from SessionManager import SessionManager, SessionBusy
+from SessionStore import SessionStore
+from Transport import TransportError
+from TurnScheduler import TurnBusy
+
+# Every browser session gets its own isolated game, kept on disk so that games survive a restart. Workers started by
+# multiworker.py share the same database.
+sessions = SessionManager(api_key="key", store=SessionStore(os.environ.get("CYOA_SESSION_DB", "sessions.db")),
+                          worker_id=os.environ.get("CYOA_WORKER_ID"))
+
+async def start_game(request: gr.Request):
+    async with sessions.turn(request.session_hash) as session:
+        return new_game(session)
+
+def new_game(session):
+    gm = session.gm
+    gm.reset_game()
+    gm.select_game(session.story_index)
+    session.game_over = False
+    sessions.save(session)
+    session.view.reset()
+    return session.view.story_update(gm), session.view.status_update(gm)
+
+async def next_action(action, request: gr.Request):
+    try:
+        async for update in play_turn(action, request.session_hash):
+            yield update
+    except SessionBusy as e:
+        print(e)
+        gr.Warning("This game is busy in another window. Please try your action again in a moment.")
+        yield gr.update(), gr.update(), gr.update(), gr.update(interactive=True)
+
+async def play_turn(action, session_id):
+    async with sessions.turn(session_id) as session:
+        if session.gm.world is None:
+            # The session expired or was evicted without a copy on disk, so there is no game left to play
+            gr.Warning("Your game had expired, so a new one has been started.")
+            yield *new_game(session), gr.update(), gr.update(value="Next", interactive=True)
+            return
+        label = "Finish" if session.game_over else "Next"
+        ticket = None
+        try:
+            # Wait for the turn scheduler to let the turn start, showing the player their place in line
+            ticket = sessions.turns.enqueue(session_id)
+            async for position in ticket.wait():
+                yield gr.update(), gr.update(), gr.update(), gr.update(value=f"Waiting ({position} ahead)")
+        except TurnBusy as e:
+            print(e)
+            gr.Warning("Too many players are taking their turn right now. Please try your action again in a moment.")
+            yield gr.update(), gr.update(), gr.update(), gr.update(value=label, interactive=True)
+            return
+        finally:
+            if ticket is not None and ticket.state != "active":
+                ticket.release()
+
+        try:
+            async for update in take_turn(action, session, label):
+                yield update
+        finally:
+            ticket.release()
+
+    # The world state is updated in the background once the outcome is in. Bring the status panel up to date when
+    # it is, without holding up the player's next turn.
+    gm = session.gm
+    if gm is not None and gm.busy:
+        await gm.wait_for_world(lag=0)
+        if session.gm is gm:
+            yield gr.update(), session.view.status_update(gm), gr.update(), gr.update()
+
+async def take_turn(action, session, label):
+    gm = session.gm
+    if session.game_over:
+        try:
+            await gm.generate_conclusion()
+        except TransportError as e:
+            # Nothing was added to the story, so the player can press Finish again
+            print(e)
+            gr.Warning("The storyteller is overwhelmed right now. Please press Finish again in a moment.")
+            yield gr.update(), gr.update(), gr.update(), gr.update(value=label, interactive=True)
+            return
+        yield session.view.story_update(gm), gr.update(), gr.update(value=""), gr.update(value=label)
     else:
-        _, is_conclusion = await gm.next_action(action)
-
-        if is_conclusion:
+        # Show the outcome as it is written; the status panel catches up once the world state is updated (see
+        # play_turn).
+        # Only the text added since the last update is sent.
+        try:
+            async for _ in gm.stream_action(action):
+                yield session.view.story_update(gm), gr.update(), gr.update(), gr.update(value=label)
+        except TransportError as e:
+            # The turn was not used up, so let the player send the same action again
+            print(e)
+            gr.Warning("The storyteller is overwhelmed right now. Please try your action again in a moment.")
+            yield session.view.story_update(gm), gr.update(), gr.update(), gr.update(value=label, interactive=True)
+            return
+
+        if gm.action_number == 0:
             update = (gr.update(value="", interactive=False), gr.update(value="Finish", interactive=True))
-            game_over = True
+            session.game_over = True
 
         else:
             update = (gr.update(value=""), gr.update(interactive=True))
 
-        return "\n\n".join(gm.current_story), gm.get_story_status(conclusion=False), *update
-
-async def reset_game():
-    gm.reset_game()
-    return await start_game()
-
-with gr.Blocks(theme="citrus") as ui:
+        yield session.view.story_update(gm), session.view.status_update(gm), *update
+
+async def reset_game(request: gr.Request):
+    return await start_game(request)
+
+async def resync(request: gr.Request):
+    """Sends both panels in full, for a browser that has missed an update."""
+    async with sessions.turn(request.session_hash) as session:
+        if session.gm.world is None:
+            return new_game(session)
+        session.view.reset()
+        return session.view.story_update(session.gm), session.view.status_update(session.gm)
+
+def end_session(request: gr.Request):
+    sessions.drop(request.session_hash)
+
+# The story and status panels are kept up to date in the browser, from the changes sent by StoryView. Changes only
+# apply on top of the update before them, so after a gap in the sequence numbers a panel ignores everything but a
+# full update, and asks for one through the hidden resync button.
+ACCEPT_UPDATE = """
+    if (!update || !target) return false;
+    const previous = Number(target.dataset.seq ?? 0);
+    if (!update.reset) {
+        if (update.seq <= previous) return false;  // Already applied
+        if (target.dataset.stale || update.seq !== previous + 1) {
+            if (!target.dataset.stale) {
+                target.dataset.stale = "1";
+                const resync = document.getElementById("resync");
+                (resync?.tagName === "BUTTON" ? resync : resync?.querySelector("button"))?.click();
+            }
+            return false;
+        }
+    }
+    delete target.dataset.stale;
+    target.dataset.seq = update.seq;
+    return true;
+"""
+
+APPLY_STORY_UPDATE = """
+(update) => {
+    const log = document.getElementById("story-log");
+    if (!((target) => {""" + ACCEPT_UPDATE + """})(log)) return;
+    if (update.reset) log.replaceChildren();
+    for (const op of update.changes) {
+        if ("truncate" in op) {
+            while (log.children.length > op.truncate) log.lastChild.remove();
+            continue;
+        }
+        while (log.children.length <= op.index) log.appendChild(document.createElement("p"));
+        const entry = log.children[op.index];
+        entry.textContent = entry.textContent.slice(0, op.offset) + op.text;
+    }
+    log.scrollTop = log.scrollHeight;
+}
+"""
+
+APPLY_STATUS_UPDATE = """
+(update) => {
+    const panel = document.getElementById("status-panel");
+    if (!((target) => {""" + ACCEPT_UPDATE + """})(panel)) return;
+    if (update.reset) panel.replaceChildren();
+    for (const [name, change] of Object.entries(update.changes)) {
+        let section = panel.querySelector(`section[data-name="${name}"]`);
+        if (!section) {
+            section = document.createElement("section");
+            section.dataset.name = name;
+            section.appendChild(document.createElement("h4")).textContent = change.heading;
+            panel.appendChild(section);
+        }
+        const entries = Object.fromEntries([...section.querySelectorAll("pre")].map((entry) => [entry.dataset.key, entry]));
+        for (const key of change.remove || []) entries[key]?.remove();
+        for (const [key, text] of Object.entries(change.upsert)) {
+            let entry = entries[key];
+            if (!entry) {
+                entry = section.appendChild(document.createElement("pre"));
+                entry.dataset.key = key;
+            }
+            entry.textContent = text;
+        }
+    }
+}
+"""
+
+CSS = """
+#story-log, #status-panel { height: 30em; overflow-y: auto; }
+#status-panel pre { white-space: pre-wrap; margin: 0 0 0.5em 0; }
+"""
+
+with gr.Blocks() as ui:
 
     gr.Markdown("# Wait, That Was an Option?")
 
     with gr.Row(equal_height=True):
-        story_display = gr.Textbox(label="Story", lines=20, interactive=False)
-        status_display = gr.Textbox(label="Status", lines=20, interactive=False)
+        with gr.Column():
+            gr.Markdown("Story")
+            gr.HTML('<div id="story-log"></div>')
+        with gr.Column():
+            gr.Markdown("Status")
+            gr.HTML('<div id="status-panel"></div>')
+    story_display = gr.JSON(visible=False)
+    status_display = gr.JSON(visible=False)
+    story_display.change(fn=None, inputs=story_display, js=APPLY_STORY_UPDATE)
+    status_display.change(fn=None, inputs=status_display, js=APPLY_STATUS_UPDATE)
 
     user_input = gr.Textbox(label="Your Action")
     with gr.Row():
         submit_btn = gr.Button("Next")
         reset_btn = gr.Button("Reset Game")
+    resync_btn = gr.Button("Resync", elem_id="resync", visible="hidden")
 
 
     user_input.submit(fn=lambda: (gr.update(interactive=False), gr.update(interactive=False)), outputs=[submit_btn, reset_btn]).then(fn=next_action, inputs=user_input, outputs=[story_display, status_display, user_input, submit_btn]).then(fn=lambda: gr.update(interactive=True), outputs=[reset_btn])
     submit_btn.click(fn=lambda: (gr.update(interactive=False), gr.update(interactive=False)), outputs=[submit_btn, reset_btn]).then(fn=next_action, inputs=user_input, outputs=[story_display, status_display, user_input, submit_btn]).then(fn=lambda: gr.update(interactive=True), outputs=[reset_btn])
     reset_btn.click(fn=lambda: (gr.update(interactive=False), gr.update(interactive=False)), outputs=[submit_btn, reset_btn]).then(fn=reset_game, outputs=[story_display, status_display]).then(fn=lambda: (gr.update(value="Next", interactive=True), gr.update(interactive=True), gr.update(interactive=True)), outputs=[submit_btn, reset_btn, user_input])
 
-    start_game_task = asyncio.run(start_game())
-    story_display.value = start_game_task[0]
-    status_display.value = start_game_task[1]
+    resync_btn.click(fn=resync, outputs=[story_display, status_display])
+
+    ui.load(fn=start_game, outputs=[story_display, status_display])
+    ui.unload(end_session)
+
+
+# Turns from different sessions may run concurrently; each session's lock keeps its own turns in order
+ui.queue(default_concurrency_limit=None)
+
+# Serve the game alongside the latency and token metrics of its model calls
+app = FastAPI()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return (sessions.tracer.export_prometheus() + sessions.response_cache.export_prometheus()
+            + sessions.turns.export_prometheus())
 
+@app.get("/metrics/histograms")
+def histograms():
+    return sessions.tracer.dump_histograms()
 
-ui.launch()
+# Gradio applies the theme and css of an app it is mounted into here, not in the Blocks constructor
+app = gr.mount_gradio_app(app, ui, path="/", theme="citrus", css=CSS)
+uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("GRADIO_SERVER_PORT", 7860)))